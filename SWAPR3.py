@@ -5,9 +5,14 @@ import sys
 import csv
 import random
 import glob
-from itertools import groupby
+from itertools import groupby, islice
 from datetime import date, datetime
 import re
+import multiprocessing
+import hashlib
+import heapq
+import pickle
+import tempfile
 
 def listdir_nohidden(path):
     # Return only the non-hidden files in a directory, to avoid that annoying .DS_Store file
@@ -54,13 +59,260 @@ def getYoutubeLink(string, verbose = False):
 def perlPerson(string):   # Generate a Perl-safe STUDENT ID (i.e. no @ sign)
     return re.sub('@','_',string);
 
-def getPerlLinksLine(wID, URLsToGrade):
-    outstring = '\t\"' + perlPerson(wID) + '\"=> [ ';
+def getPerlLinksList(URLsToGrade):
+    outstring = '[ ';
     for video in URLsToGrade:
         # outstring += '\"' + getCourseraID(video) +'\", ';
         outstring += '\"' + getedXID(video) +'\", ';
-    outstring += '],\n';
+    outstring += ']';
     return outstring
+
+def getPerlLinksLine(wID, URLsToGrade):
+    return '\t\"' + perlPerson(wID) + '\"=> ' + getPerlLinksList(URLsToGrade) + ',\n'
+
+def openCSV(filename):
+    # Open a WebAssign export (or the experts file) for csv.reader: with newline='' on Python 3, as the csv module expects ('rU' is gone as of 3.11), and with universal newlines on Python 2, whose open() has no newline argument
+    if sys.version_info[0] >= 3:
+        return open(filename, newline='')
+    return open(filename, 'rU')
+
+def readEvaluationsHeader(inputFile, filename=''):
+    # Consume the header lines of a Webassign evaluations .csv reader, up to and including the 'Fullname' line, and return (questionCols, isFlaggable, isScaffold)
+    questionCols = {}   # a dictionary of {column: wQuestion} which shows which column corresponds to the start of the responses to which wQuestion
+    # New feature as of Lab 3 S2014; students can flag assignments as unwatchable, with the following error cordes: 0) No error; 1) Video is private, missing, or unavailable; 2) Profound technical problems like missing audio; 3) This video isn't the one the presenter intended to upload
+    # NEW new feature as of SOUP 2016; we've dispensed with the multistep problems, they were too complicated for their own good.
+    isFlaggable = False
+    isScaffold = False
+    for row in inputFile:
+        if len(row) >= 1:
+            if row[0] == 'Assignment Name':
+                for word in row[1].split(' '):
+                    if word in ['Practice']:
+                        isScaffold = True
+                        print(filename+" is a scaffold assignment.")
+                    elif word in ['Evaluation']:
+                        isFlaggable = True
+                        print(filename+" is a flaggable assignment.")
+            if row[0] == "Questions":
+                for entry in row:
+                    if re.match('[0-9]',entry):    # Check to see if we've got a question number
+                        questionCols.update({row.index(entry): int(entry)})
+            if row[0] == 'Fullname':
+                break
+    return questionCols, isFlaggable, isScaffold
+
+studentEvaluationsColumns = ['term', 'wID', 'labNumber', 'URL', 'videoLabel', 'itemIndex', 'graded', 'rating', 'comment', 'runId']
+
+def iterEvaluationsRows(inputFile, questionCols, isFlaggable, isScaffold, R, lookupURL, runId, term, labNumber, wIDcol=1):
+    # Generate studentEvaluations rows, in the column order of studentEvaluationsColumns, from the student lines of a Webassign evaluations .csv reader, one student line at a time. lookupURL(wID, wQuestion) must return the (URL, videoLabel) that student saw for that question.
+    # If the question is a flaggable question, then the final (non-graded) numerical response also has a comment; if it's a scaffold question, it doesn't.
+    # TODO: This is messy; info about the structure of the WebAssign question should be encoded into the rubric
+    if isFlaggable:
+        nResponses = 2*(R + 1)
+    elif isScaffold:
+        nResponses = 2*R + 1
+    else:
+        nResponses = 0
+    for row in inputFile:
+        if len(row) > 1: # Make sure we don't have a blank line
+            if row[0] != '': # Make sure we don't have one of the score lines
+                wID = row[wIDcol]
+                for qStart, wQuestion in questionCols.items():  # go over every question
+                    URL, videoLabel = lookupURL(wID, wQuestion)
+                    # Responses alternate rating, comment, rating, comment...
+                    responses = [row[qStart + i] for i in range(nResponses)]
+                    for i in range(0, nResponses, 2):
+                        rating = responses[i]
+                        if i + 1 < nResponses:
+                            comment = responses[i + 1]
+                        else:
+                            comment = None
+                        yield (term, wID, labNumber, URL, videoLabel, i//2 + 1, None, rating, comment, runId)
+
+def assignmentLookup(assignmentMap):
+    # Turn the output of SWAPRdb.getAssignmentMap into a lookupURL(wID, wQuestion) function for iterEvaluationsRows. If the student didn't submit a URL themselves, then they got the 'default' URL assignments
+    assigned, default = assignmentMap
+    def lookupURL(wID, wQuestion):
+        try:
+            return assigned[(wID, wQuestion)]
+        except KeyError:
+            URL = default.get(wQuestion)
+            if URL is None:
+                print('Response has invalid URL: URL=None, wID='+wID+', wQuestion='+str(wQuestion))
+            return URL, 'Peer Evaluation'
+    return lookupURL
+
+def iterSubmissionRows(inputFile, labNumber, wIDcol=1, linkCol=4, verbose=False):
+    # Generate (wID, URL, youtubeURL) for every student line of a Webassign submissions .csv reader that has a valid YouTube link
+    for row in inputFile:
+        if len(row) > 1: # Make sure we don't have a blank line
+            if row[0] != '': # Make sure we don't have one of the score lines
+                wID = row[wIDcol]
+                youtubeURL = getYoutubeLink(row[linkCol])
+                if youtubeURL not in ['',None]:
+                    if verbose:
+                        print('Adding submission: wID='+wID+', URL='+youtubeURL+', labNumber='+str(labNumber))
+                    yield (wID, None, youtubeURL)
+
+assignmentsColumns = ['term', 'labNumber', 'wID', 'questionIndex', 'wQuestion', 'videoLabel', 'URL', 'runId']
+
+def ringAssignments(ring, owners, Npeer, offsets=None):
+    # The peer URLs for the owner of each URL in ring: their own URL and the next Npeer URLs, wrapping around to the beginning (or, with offsets, the URLs that many places further on). Since every window has the same shape, each URL in ring is assigned to exactly Npeer+1 students (its owner and Npeer others). Yields (wID, URLs).
+    n = len(ring)
+    if n <= Npeer:
+        print('WARNING: only '+str(n)+' peer URLs, so each student is assigned all of them')
+        Npeer = max(n - 1, 0)
+    if offsets is None:
+        offsets = range(1, Npeer + 1)
+    for i in range(n):
+        yield owners[i], [ring[i]] + [ring[(i+d)%n] for d in offsets]
+
+def spreadSections(ring, owners, sections):
+    # Reorder the ring so that each section's students are spaced evenly around it (the k-th of a section of m students goes at fraction (k+0.5)/m of the way round), keeping URL order within a section. Returns (ring, owners, section of each).
+    members = {}
+    for URL, wID in zip(ring, owners):
+        members.setdefault(sections.get(wID), []).append((URL, wID))
+    placed = []
+    for section in sorted(members, key=str):
+        m = len(members[section])
+        for k, (URL, wID) in enumerate(members[section]):
+            placed.append(((k + 0.5)/m, str(section), URL, wID, section))
+    placed.sort(key=lambda entry: entry[:2])
+    return [entry[2] for entry in placed], [entry[3] for entry in placed], [entry[4] for entry in placed]
+
+def sameSectionCount(ringSections, d):
+    # How many students are d places before someone in their own section (students with no section don't count)
+    n = len(ringSections)
+    return sum(1 for i in range(n) if ringSections[i] is not None and ringSections[i] == ringSections[(i+d)%n])
+
+def chooseOffsets(ringSections, Npeer, nCandidates=4):
+    # The Npeer offsets among the first nCandidates*Npeer with the fewest same-section reviews. All of them are less than half way round the ring, so nobody is ever assigned someone who is also assigned them. Returns (offsets, number of same-section reviews).
+    n = len(ringSections)
+    maxOffset = min((n - 1)//2, nCandidates*Npeer)
+    if maxOffset < Npeer:
+        return None, None
+    conflicts = dict((d, sameSectionCount(ringSections, d)) for d in range(1, maxOffset + 1))
+    offsets = sorted(sorted(conflicts, key=lambda d: (conflicts[d], d))[:Npeer])
+    return offsets, sum(conflicts[d] for d in offsets)
+
+def solverAssignments(ring, owners, sections, Npeer, hiddenList, hiddenPerStudent=None):
+    # The peer lists for assignURLs(solver=True): a ring with sections spread out (spreadSections), the offsets with the fewest same-section reviews (chooseOffsets), and each student given hiddenPerStudent of the hidden expert URLs in turn, so that each is assigned to the same number of students, give or take one. Returns (peer lists, report).
+    ring, owners, ringSections = spreadSections(ring, owners, sections)
+    n = len(ring)
+    offsets, sameSection = chooseOffsets(ringSections, Npeer)
+    if offsets is None:
+        print('WARNING: only '+str(n)+' peer URLs, too few to avoid reciprocal reviews')
+        offsets = list(range(1, min(Npeer, max(n - 1, 0)) + 1))
+        sameSection = sum(sameSectionCount(ringSections, d) for d in offsets)
+    if hiddenPerStudent is None or hiddenPerStudent > len(hiddenList):
+        hiddenPerStudent = len(hiddenList)
+    peerLists = list(ringAssignments(ring, owners, len(offsets), offsets))
+    hiddenCounts = dict((URL, 0) for URL in hiddenList)
+    for i, (wID, peerURLs) in enumerate(peerLists):
+        hidden = [hiddenList[(i*hiddenPerStudent + k)%len(hiddenList)] for k in range(hiddenPerStudent)]
+        for URL in hidden:
+            hiddenCounts[URL] += 1
+        peerURLs[:0] = hidden
+    report = {'students': n, 'offsets': offsets, 'reviews': n*len(offsets), 'sameSection': sameSection,
+        'reciprocal': n*sum(1 for d in offsets if n - d in offsets)//2, 'hiddenCounts': hiddenCounts}
+    return peerLists, report
+
+def printAssignmentReport(report, seconds):
+    print('Assigned '+str(report['students'])+' students in '+str(round(seconds, 2))+' s, reviewing the students '+', '.join([str(d) for d in report['offsets']])+' places after them')
+    print('    same-section reviews: '+str(report['sameSection'])+' of '+str(report['reviews']))
+    print('    reciprocal pairs: '+str(report['reciprocal']))
+    if report['hiddenCounts'] != {}:
+        print('    students per hidden calibration URL: '+str(min(report['hiddenCounts'].values()))+' to '+str(max(report['hiddenCounts'].values())))
+
+def iterAssignmentRows(peerLists, practiceList, shownList, hiddenList, term, labNumber, runId, defaultSet=True):
+    # assignments rows for each (wID, peer URLs) in peerLists: the hidden expert URLs are mixed in with the peer URLs, shuffled with the student's own random stream (seeded by their wID, so it's the same every time and doesn't touch the random module's state), and the practice and then the shown URLs go at the beginning, in order. Unless defaultSet is False, the last student's list is repeated as the 'default' set, for students who didn't submit a URL themselves.
+    URLsToGrade = None
+    for wID, peerURLs in peerLists:
+        URLsToGrade = list(hiddenList) + peerURLs
+        random.Random(wID).shuffle(URLsToGrade)
+        URLsToGrade = practiceList + shownList + URLsToGrade
+        for j in range(len(URLsToGrade)):
+            yield (term, labNumber, wID, j+1, None, None, URLsToGrade[j], runId)
+    if URLsToGrade is not None and defaultSet:
+        for j in range(len(URLsToGrade)):
+            yield (term, labNumber, 'default', j+1, None, None, URLsToGrade[j], runId)
+
+def orderedLookup(rows):
+    # For rows sorted by their first column (e.g. a cursor ORDER BY wID), a function giving the rows whose first column is key. Keys have to be asked for in the same order, so rows are only read as they're needed, and never all held in memory.
+    groups = groupby(rows, key=lambda entry: str(entry[0]))
+    current = [None, []]
+    def lookup(key):
+        while current[0] is None or current[0] < key:
+            try:
+                current[0], group = next(groups)
+                current[1] = list(group)
+            except StopIteration:
+                current[0], current[1] = key, []
+        if current[0] == key:
+            return current[1]
+        return []
+    return lookup
+
+# Per-process state for parseEvaluationsWorker, set once by the pool initializer so the assignment map isn't re-sent with every file
+_workerState = {}
+
+def initEvaluationsWorker(labNumber, term, wIDcol, R, assignmentMap, batchSize=5000):
+    _workerState.update({'labNumber': labNumber, 'term': term, 'wIDcol': wIDcol, 'R': R, 'lookupURL': assignmentLookup(assignmentMap), 'batchSize': batchSize})
+
+def parseEvaluationsWorker(task):
+    # Parse one evaluations file into studentEvaluations rows stamped with runId, without touching the database; used by SWAPRdb.ingestEvaluationsDir. The rows are spooled batchSize at a time to a temporary file (read back with iterSpool), so a worker never holds a whole file's rows in memory. Returns (filename, spool file name).
+    filename, runId = task
+    s = _workerState
+    spool = tempfile.NamedTemporaryFile(prefix='swapr', suffix='.spool', delete=False)
+    try:
+        with openCSV(filename) as csvfile:
+            inputFile = csv.reader(csvfile, delimiter='\t', quotechar='|')
+            questionCols, isFlaggable, isScaffold = readEvaluationsHeader(inputFile, filename)
+            rows = iterEvaluationsRows(inputFile, questionCols, isFlaggable, isScaffold, s['R'], s['lookupURL'], runId, s['term'], s['labNumber'], s['wIDcol'])
+            batch = list(islice(rows, s['batchSize']))
+            while batch:
+                pickle.dump(batch, spool, pickle.HIGHEST_PROTOCOL)
+                batch = list(islice(rows, s['batchSize']))
+    finally:
+        spool.close()
+    return filename, spool.name
+
+def iterSpool(spoolName):
+    # The rows parseEvaluationsWorker spooled, one batch in memory at a time; the spool file is deleted afterwards
+    try:
+        with open(spoolName, 'rb') as spool:
+            while True:
+                try:
+                    batch = pickle.load(spool)
+                except EOFError:
+                    break
+                for row in batch:
+                    yield row
+    finally:
+        os.remove(spoolName)
+
+def fileHash(filename):
+    # SHA-1 of a file's contents, read in chunks
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def functionIdentity(f):
+    # SHA-1 of a function's name, bytecode and constants, so that a cached result can tell when the function that made it has been edited
+    h = hashlib.sha1(f.__name__.encode('utf-8'))
+    codes = [f.__code__]
+    while codes:
+        code = codes.pop()
+        h.update(code.co_code)
+        for const in code.co_consts:
+            if hasattr(const, 'co_code'):
+                codes.append(const)    # e.g. a lambda inside f; its repr has a memory address in it
+            else:
+                h.update(repr(const).encode('utf-8'))
+    return h.hexdigest()
+
 def makeDatabase(databaseName):
     '''Create a blank sqlite database'''
     if databaseName[-7:] != ".sqlite":
@@ -69,21 +321,259 @@ def makeDatabase(databaseName):
     conn.commit()
     conn.close()
 
+# Tables whose wID and URL columns are stored as integer keys into studentKeys and videoKeys (schema version 2 onwards). Each one's rows live in tableNameFact; tableName itself becomes a view with the original columns, and INSTEAD OF triggers on it, so existing queries and INSERT/UPDATE/DELETE statements keep working. The triggers work a row at a time, though, so anything that writes many rows should use SWAPRdb.insertRows, which writes tableNameFact directly.
+keyedTables = ['studentEvaluations', 'assignments', 'weights', 'itemGrades', 'finalGrades']
+keyedColumns = {'wID': ('wIDkey', 'studentKeys'), 'URL': ('URLkey', 'videoKeys')}
+
+def createKeyedView(db, tableName):
+    # (Re)create the compatibility view and triggers for tableName over tableNameFact. Call this again after adding a column to a Fact table. The Fact table's runId (see runTables) is left out of the view, which rows added through it leave NULL.
+    db.cursor.execute("PRAGMA table_info("+tableName+"Fact)")
+    factColumns = [str(entry[1]) for entry in db.cursor.fetchall() if str(entry[1]) != 'runId']
+    columns = []    # [(view column, fact column, key table)]
+    for column in factColumns:
+        viewColumn = column
+        keyTable = None
+        for name, (key, table) in keyedColumns.items():
+            if column == key:
+                viewColumn, keyTable = name, table
+        columns.append((viewColumn, column, keyTable))
+
+    selects = []
+    joins = []
+    for viewColumn, column, keyTable in columns:
+        if keyTable is None:
+            selects.append('f.'+column+' AS '+viewColumn)
+        else:
+            selects.append(keyTable+'.'+viewColumn+' AS '+viewColumn)
+            joins.append(' LEFT JOIN '+keyTable+' ON '+keyTable+'.'+column+' = f.'+column)
+    # the key for a wID/URL, adding it to its key table first if it's new
+    addKeys = ''.join(['INSERT OR IGNORE INTO '+keyTable+'('+viewColumn+') SELECT NEW.'+viewColumn+' WHERE NEW.'+viewColumn+' IS NOT NULL; '
+        for viewColumn, column, keyTable in columns if keyTable is not None])
+    values = []
+    for viewColumn, column, keyTable in columns:
+        if keyTable is None:
+            values.append('NEW.'+viewColumn)
+        else:
+            values.append('(SELECT '+column+' FROM '+keyTable+' WHERE '+viewColumn+' = NEW.'+viewColumn+')')
+
+    for statement in ['DROP VIEW IF EXISTS '+tableName, 'DROP TRIGGER IF EXISTS '+tableName+'Insert', 'DROP TRIGGER IF EXISTS '+tableName+'Update', 'DROP TRIGGER IF EXISTS '+tableName+'Delete']:
+        db.cursor.execute(statement)
+    db.cursor.execute('CREATE VIEW '+tableName+' AS SELECT '+', '.join(selects)+' FROM '+tableName+'Fact f'+''.join(joins))
+    db.cursor.execute('CREATE TRIGGER '+tableName+'Insert INSTEAD OF INSERT ON '+tableName+' BEGIN '+addKeys+
+        'INSERT INTO '+tableName+'Fact('+', '.join(factColumns)+') VALUES ('+', '.join(values)+'); END')
+    db.cursor.execute('CREATE TRIGGER '+tableName+'Update INSTEAD OF UPDATE ON '+tableName+' BEGIN '+addKeys+
+        'UPDATE '+tableName+'Fact SET '+', '.join([column+' = '+value for column, value in zip(factColumns, values)])+' WHERE row = OLD.row; END')
+    db.cursor.execute('CREATE TRIGGER '+tableName+'Delete INSTEAD OF DELETE ON '+tableName+' BEGIN DELETE FROM '+tableName+'Fact WHERE row = OLD.row; END')
+
+def migrateToSurrogateKeys(db):
+    # Move every table in keyedTables into tableNameFact with integer wIDkey/URLkey columns, and put a compatibility view in its place
+    db.cursor.execute('''CREATE TABLE IF NOT EXISTS studentKeys
+        (wIDkey INTEGER PRIMARY KEY NOT NULL,
+            wID text UNIQUE)
+    ''')
+    db.cursor.execute('''CREATE TABLE IF NOT EXISTS videoKeys
+        (URLkey INTEGER PRIMARY KEY NOT NULL,
+            URL text UNIQUE)
+    ''')
+    for tableName in keyedTables:
+        db.cursor.execute("PRAGMA table_info("+tableName+")")
+        tableColumns = [[str(entry[1]), str(entry[2])] for entry in db.cursor.fetchall()]
+        definitions = []
+        selects = []
+        joins = []
+        for column, columnType in tableColumns:
+            if column == 'row':
+                definitions.append('row INTEGER PRIMARY KEY NOT NULL')
+                selects.append('t.row')
+            elif column in keyedColumns:
+                key, keyTable = keyedColumns[column]
+                db.cursor.execute('INSERT OR IGNORE INTO '+keyTable+'('+column+') SELECT DISTINCT '+column+' FROM '+tableName+' WHERE '+column+' IS NOT NULL')
+                definitions.append(key+' int')
+                selects.append(keyTable+'.'+key)
+                joins.append(' LEFT JOIN '+keyTable+' ON '+keyTable+'.'+column+' = t.'+column)
+            else:
+                definitions.append(column+' '+columnType)
+                selects.append('t.'+column)
+        db.cursor.execute('CREATE TABLE '+tableName+'Fact ('+', '.join(definitions)+')')
+        db.cursor.execute('INSERT INTO '+tableName+'Fact SELECT '+', '.join(selects)+' FROM '+tableName+' t'+''.join(joins))
+        db.cursor.execute('DROP TABLE '+tableName)
+        createKeyedView(db, tableName)
+
+# Tables whose rows are stamped with the ingestRuns.runId of the pipeline call that wrote them, so a whole run can be undone with SWAPRdb.rollbackRun (schema version 3 onwards). The stamp stays out of the columns other code sees, so INSERTs that give every column's value in order (as SWAPR3grades' do) keep working: for a table in keyedTables it's a column of tableNameFact, which the view leaves out, and for the rest it's kept in a side table, tableNameRuns, keyed by row (see SWAPRdb.stampRun and SWAPRdb.runRows).
+runTables = ['studentEvaluations', 'submissions', 'expertEvaluations', 'students', 'rubrics', 'ratingKeys', 'assignments', 'weights', 'itemGrades', 'finalGrades', 'calibrationGrades']
+
+def addRunIds(db):
+    db.cursor.execute('''CREATE TABLE IF NOT EXISTS ingestRuns
+        (runId INTEGER PRIMARY KEY NOT NULL,
+            startTime timestamp,
+            endTime timestamp,
+            stage text,
+            labNumber int,
+            term text,
+            source text,
+            nRows int,
+            status text)
+    ''')
+    for tableName in runTables:
+        if tableName in keyedTables:
+            db.cursor.execute('ALTER TABLE '+tableName+'Fact ADD COLUMN runId int')
+            db.cursor.execute('CREATE INDEX IF NOT EXISTS '+tableName+'ByRun ON '+tableName+'Fact(runId)')
+        else:
+            db.cursor.execute('CREATE TABLE IF NOT EXISTS '+tableName+'Runs (row INTEGER PRIMARY KEY NOT NULL, runId int)')
+            db.cursor.execute('CREATE INDEX IF NOT EXISTS '+tableName+'ByRun ON '+tableName+'Runs(runId)')
+            # a row's stamp goes when the row does, however it's deleted
+            db.cursor.execute('CREATE TRIGGER IF NOT EXISTS '+tableName+'RunsDelete AFTER DELETE ON '+tableName+' BEGIN DELETE FROM '+tableName+'Runs WHERE row = OLD.row; END')
+
+def addDatabaseId(db):
+    # Caches kept outside the database (see SWAPR3cube.loadEvaluationCube) are keyed on this, since a database deleted and rebuilt at the same path can end up with the same row counts and changeIds as the old one
+    db.cursor.execute('''CREATE TABLE IF NOT EXISTS databaseId
+        (id text NOT NULL,
+            time timestamp)
+    ''')
+    db.cursor.execute("INSERT INTO databaseId(id,time) VALUES (?,?)",[hashlib.sha1(os.urandom(32)).hexdigest()[:16],datetime.now()])
+
+# Tables whose changes make a lab's weights and grades out of date (schema version 4 onwards). A change to a reviewer's studentEvaluations only affects that reviewer; the others affect the whole lab. See SWAPRdb.getChanges.
+changeTables = {'studentEvaluations': 'wIDkey', 'expertEvaluations': None, 'rubrics': None, 'ratingKeys': None}
+
+def addChangeTracking(db):
+    db.cursor.execute('''CREATE TABLE IF NOT EXISTS evaluationChanges
+        (changeId INTEGER PRIMARY KEY NOT NULL,
+            labNumber int,
+            wIDkey int)
+    ''')
+    db.cursor.execute('''CREATE TABLE IF NOT EXISTS changeWatermarks
+        (consumer text NOT NULL,
+            labNumber int NOT NULL,
+            changeId int,
+            PRIMARY KEY(consumer, labNumber))
+    ''')
+    db.cursor.execute('''CREATE INDEX IF NOT EXISTS evaluationChangesByLab ON evaluationChanges(labNumber, changeId)''')
+    for tableName, key in changeTables.items():
+        storage = db.storageTable(tableName)
+        for event, rowName in [('INSERT', 'NEW'), ('DELETE', 'OLD'), ('UPDATE', 'OLD'), ('UPDATE', 'NEW')]:
+            reviewer = rowName+'.'+key if key is not None else 'NULL'
+            # Inserts and deletes aren't logged again if the latest entry is already the same one, since ingests and rollbacks write a reviewer's rows one after another. Updates always are, so that getLabFingerprint sees them.
+            unlessLatest = ''
+            if event != 'UPDATE':
+                unlessLatest = ' WHERE NOT EXISTS (SELECT 1 FROM evaluationChanges WHERE changeId = (SELECT max(changeId) FROM evaluationChanges) AND labNumber IS '+rowName+'.labNumber AND wIDkey IS '+reviewer+')'
+            db.cursor.execute('CREATE TRIGGER '+tableName+'Changed'+event.capitalize()+rowName.capitalize()+' AFTER '+event+' ON '+storage+
+                ' BEGIN INSERT INTO evaluationChanges(labNumber, wIDkey) SELECT '+rowName+'.labNumber, '+reviewer+unlessLatest+'; END')
+
+# Schema changes on top of the tables made by SWAPRdb.createTables, as (version, description, steps). Each step is either a SQL statement or a function that takes the SWAPRdb. SWAPRdb.migrate() applies the ones a database doesn't have yet, in order, so add new entries at the end and never edit old ones.
+schemaMigrations = [
+    (1, 'Secondary indexes for the evaluation, weight, grade and report joins', [
+        '''CREATE INDEX IF NOT EXISTS studentEvaluationsBywID ON studentEvaluations(labNumber, wID, URL, itemIndex)''',
+        '''CREATE INDEX IF NOT EXISTS studentEvaluationsByURL ON studentEvaluations(labNumber, URL, itemIndex)''',
+        '''CREATE INDEX IF NOT EXISTS expertEvaluationsByURL ON expertEvaluations(labNumber, URL, itemIndex)''',
+        '''CREATE INDEX IF NOT EXISTS assignmentsBywID ON assignments(labNumber, wID, wQuestion)''',
+        '''CREATE INDEX IF NOT EXISTS weightsByType ON weights(labNumber, weightType, nCalibration, wID)''',
+        '''CREATE INDEX IF NOT EXISTS itemGradesByAlgorithm ON itemGrades(labNumber, algorithm, wID)''',
+        '''ANALYZE''',
+        ]),
+    (2, 'Integer surrogate keys for wID and URL, with compatibility views', [
+        migrateToSurrogateKeys,
+        '''CREATE INDEX IF NOT EXISTS studentEvaluationsBywID ON studentEvaluationsFact(labNumber, wIDkey, URLkey, itemIndex)''',
+        '''CREATE INDEX IF NOT EXISTS studentEvaluationsByURL ON studentEvaluationsFact(labNumber, URLkey, itemIndex)''',
+        '''CREATE INDEX IF NOT EXISTS assignmentsBywID ON assignmentsFact(labNumber, wIDkey, wQuestion)''',
+        '''CREATE INDEX IF NOT EXISTS weightsByType ON weightsFact(labNumber, weightType, nCalibration, wIDkey)''',
+        '''CREATE INDEX IF NOT EXISTS itemGradesByAlgorithm ON itemGradesFact(labNumber, algorithm, wIDkey)''',
+        '''CREATE INDEX IF NOT EXISTS finalGradesByAlgorithm ON finalGradesFact(labNumber, algorithm, wIDkey)''',
+        '''ANALYZE''',
+        ]),
+    (3, 'ingestRuns ledger, and a runId on every row', [
+        addRunIds,
+        ]),
+    (4, 'Change log of evaluations, expert evaluations and rubrics, for incremental weights and grades', [
+        addChangeTracking,
+        ]),
+    (5, 'stageCache of which inputs each weight and grade stage last ran on', [
+        '''CREATE TABLE IF NOT EXISTS stageCache
+            (stage text NOT NULL,
+                labNumber int NOT NULL,
+                fingerprint text,
+                runId int,
+                time timestamp,
+                PRIMARY KEY(stage, labNumber))''',
+        ]),
+    (6, 'runId of the ingest run behind each ingestManifest entry', [
+        '''ALTER TABLE ingestManifest ADD COLUMN runId int''',
+        ]),
+    (7, 'A random id for this database, to tell it apart from another one made at the same path', [
+        addDatabaseId,
+        ]),
+    ]
+
+# PRAGMA settings for SWAPRdb(databaseName, profile=...). WAL journaling lets report scripts read while an ingest or grading run is writing; it's a property of the database file, so it sticks once set, and switching needs a moment with no other connection writing. So only the writers' profiles ask for it (and connect() leaves it alone if the file is already in that mode); report scripts use 'report', which never touches journal_mode. The rest are per-connection: cache_size is in KiB when negative, mmap_size in bytes.
+connectionProfiles = {
+    'default': [],
+    'wal': [('journal_mode', 'WAL'), ('synchronous', 'NORMAL'), ('cache_size', -262144), ('mmap_size', 1073741824), ('temp_store', 'MEMORY')],
+    # for big ingests you can re-run if the machine goes down mid-way
+    'bulk': [('journal_mode', 'WAL'), ('synchronous', 'OFF'), ('cache_size', -1048576), ('mmap_size', 4294967296), ('temp_store', 'MEMORY')],
+    # for scripts that only read, alongside a writer using 'wal' or 'bulk'
+    'report': [('cache_size', -262144), ('mmap_size', 1073741824), ('temp_store', 'MEMORY')],
+    }
+
+# Profiles that mustn't write to the database, so SWAPRdb won't migrate one opened with them (see SWAPRdb.__init__)
+readOnlyProfiles = ['report']
+
 class SWAPRdb:
     '''class for connecting, inserting, and retrieving information from a sqlite3 database'''   
     # connects to the database, alters its name if named incorrectly
-    def __init__(self, databaseName):
+    # profile is a key of connectionProfiles (or a list of (pragma, value) pairs); readers is the number of extra read-only connections to open for reports, see reader()
+    def __init__(self, databaseName, profile='default', readers=0):
         if databaseName[-7:] != ".sqlite":
             databaseName = databaseName + ".sqlite"
         if os.path.isfile(databaseName):
             self.databaseName = databaseName;
-            self.conn = sqlite3.connect(self.databaseName)
+            readOnly = not isinstance(profile, list) and profile in readOnlyProfiles
+            if not isinstance(profile, list) and profile in connectionProfiles:
+                profile = connectionProfiles[profile]
+            self.profile = profile
+            self.conn = self.connect()
             self.cursor = self.conn.cursor()
-            self.conn.text_factory = str
+            # A database made by an older version of this code is brought up to date as soon as it's opened (missing tables, then pending migrations), since every writer expects the latest schema. A blank one is left for createTables. A read-only profile never rewrites the tables behind a report's back; the database has to be opened by a writer first.
+            self.cursor.execute("SELECT count(*) FROM sqlite_master WHERE name = 'studentEvaluations'")
+            version = self.getSchemaVersion() if self.cursor.fetchone()[0] > 0 else None
+            if version is not None and version < schemaMigrations[-1][0]:
+                if readOnly:
+                    self.conn.close()
+                    sys.exit("This database's schema is out of date (version "+str(version)+", this code needs "+str(schemaMigrations[-1][0])+"); open it once with a writer profile, e.g. SWAPRdb(databaseName), to migrate it")
+                self.createTables()
+            self.readers = []
+            for i in range(readers):
+                conn = self.connect()
+                conn.execute('PRAGMA query_only = ON')
+                self.readers.append(conn)
+            self.nextReader = 0
         else:
             # sees if database name is unique, so it doesn't overwrite anything
             sys.exit("This database does not exist, use the makeDatabase(databaseName) to create it")
 
+    def connect(self):
+        # Open a new connection to this database with the profile's PRAGMAs applied
+        conn = sqlite3.connect(self.databaseName)
+        conn.text_factory = str
+        for pragma, value in self.profile:
+            if pragma == 'journal_mode' and str(conn.execute('PRAGMA journal_mode').fetchone()[0]).upper() == str(value).upper():
+                continue
+            conn.execute('PRAGMA '+pragma+' = '+str(value))
+        return conn
+
+    def reader(self):
+        # A read-only connection for reports, handed out round-robin from the pool opened in __init__. Under a WAL profile these neither block nor get blocked by a long ingest on self.conn. Falls back to self.conn if there's no pool.
+        if self.readers == []:
+            return self.conn
+        conn = self.readers[self.nextReader % len(self.readers)]
+        self.nextReader += 1
+        return conn
+
+    def close(self):
+        for conn in self.readers:
+            conn.close()
+        self.readers = []
+        self.conn.commit()
+        self.conn.close()
+
     def createTables(self):
         # create tables if they do not exist
 
@@ -224,115 +714,142 @@ class SWAPRdb:
                 weightType text)
         ''')
 
-    def writeCommentsTabDelimited(self,filename,labNumber,algorithm='offMean_1',weightType = 'weightDIBI_full_curved',writeEmails = False,reportWeights = True, reportGrades = True):
+        # one entry per ingested source file: its content hash and the range of rows it wrote to tableName (and, from schema version 6, the runId they carry)
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS ingestManifest
+            (row INTEGER PRIMARY KEY NOT NULL,
+                time timestamp,
+                tableName text,
+                filename text,
+                labNumber int,
+                fileHash text,
+                firstRow int,
+                lastRow int,
+                nRows int,
+                UNIQUE(tableName, filename))
+        ''')
+        self.conn.commit()
+
+        # indexes and everything else added since
+        self.migrate()
+
+    def getSchemaVersion(self):
+        # The number of the last migration in schemaMigrations applied to this database; 0 for a database that predates them. Only reads, so it's safe on a read-only profile.
+        self.cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'schemaVersion'")
+        if self.cursor.fetchone()[0] == 0:
+            return 0
+        self.cursor.execute("SELECT max(version) FROM schemaVersion")
+        version = self.cursor.fetchone()[0]
+        if version is None:
+            return 0
+        return int(version)
+
+    def migrate(self, verbose=True):
+        # Upgrade the database in place by applying every migration in schemaMigrations newer than its schemaVersion. Each migration runs in its own transaction, so a failure leaves the database at the last good version. Expects the tables from createTables to exist.
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS schemaVersion
+            (version INTEGER PRIMARY KEY NOT NULL,
+                time timestamp,
+                description text)
+        ''')
+        current = self.getSchemaVersion()
+        self.conn.commit()
+        isolationLevel = self.conn.isolation_level
+        self.conn.isolation_level = None   # we manage the transactions ourselves, so that DDL doesn't commit halfway through a migration
+        try:
+            for version, description, steps in schemaMigrations:
+                if version <= current:
+                    continue
+                self.cursor.execute('BEGIN')
+                try:
+                    for step in steps:
+                        if callable(step):
+                            step(self)
+                        else:
+                            self.cursor.execute(step)
+                    self.cursor.execute("INSERT INTO schemaVersion(version,time,description) VALUES (?,?,?)",[version,datetime.now(),description])
+                    self.cursor.execute('COMMIT')
+                except:
+                    self.cursor.execute('ROLLBACK')
+                    raise
+                current = version
+                if verbose:
+                    print('Migrated '+self.databaseName+' to schema version '+str(version)+': '+description)
+        finally:
+            self.conn.isolation_level = isolationLevel
 
-        itemIndices=[1,2,3,4,5]
+    def writeCommentsTabDelimited(self,filename,labNumber,algorithm='offMean_1',weightType = 'weightDIBI_full_curved',writeEmails = False,reportWeights = True, reportGrades = True):
+        # One line per student with a submission: for each graded item in the lab's rubric, its topic, the student's item score (with reportGrades) and their peers' comments.
+        # The comments, item grades and emails each come from one query in wID order, which are walked through side by side (see orderedLookup) and written out a student at a time, so the report never holds more than one student's rows. (weightType and reportWeights are kept for old callers; the weights were never part of the report.)
+        self.cursor.execute('''SELECT rubrics.itemIndex, rubrics.topic, max(ratingKeys.score)
+            FROM rubrics LEFT JOIN ratingKeys
+                ON ratingKeys.labNumber = rubrics.labNumber
+                AND ratingKeys.itemIndex = rubrics.itemIndex
+            WHERE
+                rubrics.labNumber = ?
+                AND rubrics.graded
+            GROUP BY rubrics.itemIndex
+            ORDER BY rubrics.itemIndex''',[labNumber])
+        items = [(int(entry[0]), str(entry[1]), entry[2]) for entry in self.cursor.fetchall()]
+        itemIndices = [entry[0] for entry in items]
+
+        comments = self.conn.cursor()
+        comments.execute('''SELECT submissions.wID, submissions.URL, studentEvaluations.itemIndex, comment
+            FROM studentEvaluations, submissions
+            WHERE 
+                submissions.URL = studentEvaluations.URL 
+                and submissions.labNumber = ? 
+                AND studentEvaluations.labNumber = submissions.labNumber 
+                AND studentEvaluations.itemIndex IN (SELECT itemIndex FROM rubrics WHERE labNumber = ? AND graded)
+                AND comment IS NOT NULL
+                ORDER BY submissions.wID, studentEvaluations.itemIndex, studentEvaluations.row''',[labNumber, labNumber])
+        if reportGrades:
+            grades = self.conn.cursor()
+            grades.execute("SELECT wID, itemIndex, itemScore FROM itemGrades WHERE labNumber = ? AND algorithm = ? ORDER BY wID, itemIndex, row",[labNumber, algorithm])
+            getGrades = orderedLookup(grades)
+        if writeEmails:
+            emails = self.conn.cursor()
+            emails.execute("SELECT wID, email FROM students WHERE email IS NOT NULL ORDER BY wID, row")
+            getEmails = orderedLookup(emails)
 
         with open(filename,'w') as output:
             labelString = "Username"
             if writeEmails:
                 labelString += "\tEmail"
             labelString += "\tURL"
-            # for i in range(5):
-            # TODO: don't hard-code the number of studentEvaluations
-            if reportGrades:
-                for i in range(len(itemIndices)):
-                    labelString+="\tItem "+str(i+1)+"\tItem "+str(i+1)+" Grade\tItem "+str(i+1)+" Comments"
-                labelString += "\n"
-                output.write(labelString)
-            else:
-                for i in range(len(itemIndices)):
-                    labelString+="\tItem "+str(i+1)+"\tItem "+str(i+1)+" Comments"
-                labelString += "\n"
-                output.write(labelString)
-            # Get the list of item prompts
-            # self.cursor.execute("SELECT itemPrompt FROM rubrics WHERE labNumber = ? AND itemType = 'freeResponse' AND itemIndex != 14 ORDER BY itemIndex",[labNumber])
-            # Get the list of item prompts (5-item extra credit rubric)
-            self.cursor.execute("SELECT topic FROM rubrics WHERE labNumber = ? AND itemIndex != 6 ORDER BY itemIndex",[labNumber])
-            prompts = [str(prompt[0]) for prompt in self.cursor.fetchall()]
-
-            self.cursor.execute('''SELECT submissions.wID, submissions.URL, studentEvaluations.itemIndex, comment
-                FROM studentEvaluations, submissions
-                WHERE 
-                    submissions.URL = studentEvaluations.URL 
-                    and submissions.labNumber = ? 
-                    AND studentEvaluations.labNumber = submissions.labNumber 
-                    AND studentEvaluations.itemIndex != 6 
-                    ORDER BY submissions.wID, studentEvaluations.itemIndex''',[labNumber])
-            data = [[str(entry[0]),str(entry[1]),int(entry[2]),str(entry[3])] for entry in self.cursor.fetchall() if entry[3] != None]
-            for wID, studentEvaluations in groupby(data,key = lambda x: x[0]):
-                studentEvaluations = list(studentEvaluations)
-                URL = studentEvaluations[0][1]
+            for i in range(len(itemIndices)):
+                labelString += "\tItem "+str(i+1)
+                if reportGrades:
+                    labelString += "\tItem "+str(i+1)+" Grade"
+                labelString += "\tItem "+str(i+1)+" Comments"
+            labelString += "\n"
+            output.write(labelString)
+
+            for wID, studentEvaluations in groupby(comments, key = lambda x: str(x[0])):
                 # Get the student's peers' comments
                 peerComments = {}
-                for itemIndex, itemstudentEvaluations in groupby(studentEvaluations,key = lambda x: x[2]):
-                    thisstudentEvaluations = ''
-                    for entry in itemstudentEvaluations:
-                        thisstudentEvaluations+=entry[3]+'; '
-                    peerComments.update({itemIndex: thisstudentEvaluations})
-                if reportWeights:
-                    # self.cursor.execute("SELECT weight1, weight2, weight3, weight4, weight5, weight6 FROM weightsBIBI WHERE wID = ? and labNumber = ?",[wID, labNumber])
-                    # weights = [[float(d[i]) for i in range(6)] for d in self.cursor.fetchall()]
-                    self.cursor.execute('''SELECT weight
-                        FROM weights
-                        WHERE 
-                            wID = ?
-                            AND labNumber = ?
-                            AND weightType = ?
-                            AND nCalibration = 3
-                        ORDER BY wID,itemIndex
-                            ''',[wID,labNumber,weightType])
-                    weights = [float(entry[0]) for entry in self.cursor.fetchall()]
-
-                # Get the student's grade vector
-                if reportGrades:
-                    self.cursor.execute("SELECT itemScore FROM itemGrades WHERE wID = ? and itemGrades.labNumber = ? AND algorithm = ? ORDER BY itemIndex",[wID, labNumber,algorithm])
-                    gradeVector = [item for item in self.cursor.fetchall()]
-                    if gradeVector == []:
-                        gradeVector = [0,0,0,0,0]
-                    else:
-                        gradeVector = [float(entry[0]) for entry in gradeVector]
-
-                # Get email, if appropriate
-                if writeEmails:
-                    hasEmail = checkEmail(self, wID)
-                    if hasEmail:
-                        self.cursor.execute("SELECT email FROM students WHERE wID = ?",[wID])
-                        email = str(self.cursor.fetchone()[0])
-                    # print(email)
-                dataString = ''
-                if writeEmails:
-                    if hasEmail:
-                        try:
-                            dataString += email
-                            dataString += '\t'
-                        except:
-                            dataString += '\t'
-                dataString += wID.split('@')[0]
+                URL = None
+                for entry in studentEvaluations:
+                    if URL is None:
+                        URL = str(entry[1])
+                    peerComments[int(entry[2])] = peerComments.get(int(entry[2]), '') + str(entry[3]) + '; '
+
+                dataString = wID.split('@')[0]
                 dataString += '\t'
+                if writeEmails:
+                    studentEmails = getEmails(wID)
+                    if studentEmails != []:
+                        dataString += str(studentEmails[-1][1])    # the latest
+                    dataString += '\t'
                 if URL is not None:
                     dataString += URL
-                # for i in range(6):
-                # TODO: don't hard code this
-                for index in itemIndices:
-                    i = itemIndices.index(index)
-                    # if len(peerComments) > 0:
-                        # for comment in peerComments:
-                        # print(peerComments)
-                        #   iComments += comment[i]+'; '
-                    dataString += '\t'+prompts[i]+'\t'
+
+                # Get the student's grade vector (the latest score for each item; 0 if there's none)
+                if reportGrades:
+                    gradeVector = dict((int(entry[1]), float(entry[2])) for entry in getGrades(wID))
+                for itemIndex, topic, maxScore in items:
+                    dataString += '\t'+topic+'\t'
                     if reportGrades:
-                        dataString+=str('%.2f'%gradeVector[i])+'/20\t'
-                    try:
-                        dataString+=str(peerComments[index])
-                    except: 
-                        dataString+='(No peer comments)'
-                    # else:
-                    #   dataString += '\t'+prompts[i]+'\t'+str('%.2f'%gradeVector[i])+'%\t'+''
-                    # try:
-                    #   dataString += '\t'+str('%.2f' % (weights[i]*100))+'%'
-                    # except:
-                    #   dataString += '\t'+''
+                        dataString += str('%.2f'%gradeVector.get(itemIndex, 0))+'/'+('%g' % maxScore if maxScore is not None else '')+'\t'
+                    dataString += peerComments.get(itemIndex, '(No peer comments)')
                 dataString+='\n'
 
                 output.write(dataString)
@@ -400,13 +917,181 @@ class SWAPRdb:
         Ngraded = int(self.cursor.fetchone()[0])
         return Ngraded
 
-    def addStudentSubmission(self,wID,youtubeURL,labNumber,URL=None,term='SOUP2016'):
+    def beginRun(self, stage, labNumber=None, term=None, source=None):
+        # Open an entry in the ingestRuns ledger for one pipeline call, and return its runId to stamp that call's rows with. Doesn't commit, so the entry only sticks if the rows do.
+        self.cursor.execute("INSERT INTO ingestRuns(runId,startTime,stage,labNumber,term,source,status) VALUES (NULL,?,?,?,?,?,'open')",[datetime.now(),stage,labNumber,term,source])
+        return self.cursor.lastrowid
+
+    def endRun(self, runId, nRows=None, status='done'):
+        self.cursor.execute("UPDATE ingestRuns SET endTime = ?, nRows = ?, status = ? WHERE runId = ?",[datetime.now(),nRows,status,runId])
+
+    def listRuns(self, labNumber=None, stage=None):
+        # [runId, startTime, stage, labNumber, term, source, nRows, status] for every run, optionally only those for one lab and/or stage
+        self.cursor.execute('''SELECT runId, startTime, stage, labNumber, term, source, nRows, status
+            FROM ingestRuns
+            WHERE
+                (? IS NULL OR labNumber = ?)
+                AND (? IS NULL OR stage = ?)
+            ORDER BY runId''',[labNumber,labNumber,stage,stage])
+        return [list(entry) for entry in self.cursor.fetchall()]
+
+    def rollbackRun(self, runId):
+        # Undo a pipeline call: delete every row it wrote, from every table in runTables. Files whose rows go away this way will be ingested again next time (see checkManifest). The watermarks (see getChanges) of the lab's consumers of a table the run wrote to are dropped too, since the results they vouch for may have just gone (as an updateWeights run's weights do), so those are recomputed in full next time.
+        self.cursor.execute("SELECT labNumber FROM ingestRuns WHERE runId = ?",[runId])
+        entry = self.cursor.fetchone()
+        labNumber = entry[0] if entry is not None else None
+        nRows = 0
+        for tableName in runTables:
+            self.cursor.execute("DELETE FROM "+self.storageTable(tableName)+" WHERE row IN (SELECT row FROM "+self.runRows(tableName)+" WHERE runId = ?)",[runId])
+            if self.cursor.rowcount > 0:
+                nRows += self.cursor.rowcount
+                self.cursor.execute("DELETE FROM changeWatermarks WHERE consumer LIKE ? AND (? IS NULL OR labNumber = ?)",[tableName+' %',labNumber,labNumber])
+        self.endRun(runId, nRows, status='rolled back')
+        self.conn.commit()
+        print('Rolled back run '+str(runId)+' ('+str(nRows)+' rows)')
+        return nRows
+
+    def checkManifest(self, tableName, filename, skipUnchanged=True):
+        # Compare a source file against the ingest manifest. Returns (fileHash, skip); skip is True when the file is unchanged since it was last ingested (and skipUnchanged). Otherwise, if the file was ingested before, the rows it wrote to tableName are deleted here, so the caller can re-ingest it from scratch. Doesn't commit.
+        fileKey = os.path.abspath(filename)
+        thisHash = fileHash(filename)
+        self.cursor.execute("SELECT fileHash, runId, firstRow, lastRow, nRows FROM ingestManifest WHERE tableName = ? AND filename = ?",[tableName, fileKey])
+        entry = self.cursor.fetchone()
+        if entry is None:
+            return thisHash, False
+        oldHash, runId, firstRow, lastRow, nRows = entry
+        # Only trust the entry if nobody has deleted its rows by hand since. Entries from before schema version 6 have no runId, only a row range; row isn't AUTOINCREMENT, so the range may since have been refilled by other files' rows, which all carry a runId.
+        if runId is not None:
+            where, args = "runId = ?", [runId]
+        else:
+            where, args = "row BETWEEN ? AND ? AND runId IS NULL", [firstRow, lastRow]
+        if runId is not None or firstRow is not None:
+            self.cursor.execute("SELECT count(*) FROM "+self.runRows(tableName)+" WHERE "+where, args)
+            intact = self.cursor.fetchone()[0] == nRows
+        else:
+            intact = True
+        if oldHash == thisHash and intact and skipUnchanged:
+            return thisHash, True
+        if runId is not None or (firstRow is not None and intact):
+            self.cursor.execute("DELETE FROM "+self.storageTable(tableName)+" WHERE row IN (SELECT row FROM "+self.runRows(tableName)+" WHERE "+where+")", args)
+            if self.cursor.rowcount > 0:
+                print('Replacing '+str(self.cursor.rowcount)+' rows of '+tableName+' from '+filename)
+        return thisHash, False
+
+    def storageTable(self, tableName):
+        # The table that actually holds tableName's rows: tableName itself, or tableNameFact once it has been turned into a view over integer keys (see keyedTables). Use it for row-range scans and deletes, which the view can't do efficiently.
+        if tableName in keyedTables:
+            self.cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?",[tableName+'Fact'])
+            if self.cursor.fetchone()[0] > 0:
+                return tableName+'Fact'
+        return tableName
+
+    def runRows(self, tableName):
+        # A FROM clause for the rows of tableName (one of runTables) with the runId they're stamped with, NULL for rows written outside any run: tableNameFact for a table in keyedTables, otherwise tableName joined to its tableNameRuns
+        if tableName in keyedTables:
+            return self.storageTable(tableName)
+        return tableName+' LEFT JOIN '+tableName+'Runs USING(row)'
+
+    def stampRun(self, tableName, runId, afterRow):
+        # Stamp the rows of tableName (one of runTables, but not of keyedTables, whose rows carry their own runId) after row afterRow with runId. Take afterRow from getMaxRow just before writing a run's rows: new rows always go after the last one. Doesn't commit.
+        self.cursor.execute("INSERT OR REPLACE INTO "+tableName+"Runs(row, runId) SELECT row, ? FROM "+tableName+" WHERE row > ?",[runId, afterRow])
+
+    def getMaxRow(self, tableName):
+        self.cursor.execute("SELECT max(row) FROM "+self.storageTable(tableName))
+        maxRow = self.cursor.fetchone()[0]
+        if maxRow is None:
+            return 0
+        return int(maxRow)
+
+    def getDatabaseId(self):
+        # The random id this database was given by schema version 7
+        self.cursor.execute("SELECT id FROM databaseId")
+        return str(self.cursor.fetchone()[0])
+
+    def getLabFingerprint(self, labNumber, tableNames=('studentEvaluations', 'expertEvaluations', 'rubrics')):
+        # A short hash of which rows tableNames hold for labNumber, and of the lab's latest entry in evaluationChanges (which every UPDATE adds to), so it changes whenever the lab's inputs do. It includes the database's id, so it also changes if the database is rebuilt from scratch, even with the same rows.
+        h = hashlib.sha1(self.getDatabaseId().encode('utf-8'))
+        for tableName in tableNames:
+            self.cursor.execute("SELECT count(*), max(row), total(row) FROM "+self.storageTable(tableName)+" WHERE labNumber = ?",[labNumber])
+            h.update((tableName+repr(tuple(self.cursor.fetchone()))).encode('utf-8'))
+        self.cursor.execute("SELECT max(changeId) FROM evaluationChanges WHERE labNumber = ?",[labNumber])
+        h.update(('evaluationChanges'+repr(self.cursor.fetchone()[0])).encode('utf-8'))
+        return h.hexdigest()[:16]
+
+    def getStageFingerprint(self, labFingerprint, identity):
+        # A short hash of labFingerprint (what getLabFingerprint gave for the stage's input tables) and identity, a string naming the stage's algorithm and settings. A caller with several stages on the same tables works labFingerprint out once for all of them, since each getLabFingerprint scans the tables.
+        h = hashlib.sha1((labFingerprint+identity).encode('utf-8'))
+        return h.hexdigest()[:16]
+
+    def getCachedStage(self, stage, labNumber, fingerprint, tableName, where='', args=[]):
+        # The runId of stage's results for labNumber, if they were computed from inputs with this fingerprint and some of them are still in tableName (not rolled back or deleted since); otherwise None. where and args narrow that check to the stage's own rows, e.g. one weightType.
+        self.cursor.execute("SELECT runId, fingerprint FROM stageCache WHERE stage = ? AND labNumber = ?",[stage,labNumber])
+        cached = self.cursor.fetchone()
+        if cached is None or cached[1] != fingerprint:
+            return None
+        self.cursor.execute("SELECT count(*) FROM (SELECT 1 FROM "+self.runRows(tableName)+" WHERE labNumber = ? AND runId = ?"+(" AND "+where if where != '' else '')+" LIMIT 1)",[labNumber,cached[0]]+list(args))
+        if self.cursor.fetchone()[0] == 0:
+            return None
+        return cached[0]
+
+    def recordStage(self, stage, labNumber, fingerprint, runId):
+        # Record that run runId computed stage's results for labNumber from inputs with this fingerprint. Doesn't commit; do it in the same transaction as the results.
+        self.cursor.execute("INSERT OR REPLACE INTO stageCache(stage,labNumber,fingerprint,runId,time) VALUES (?,?,?,?,?)",[stage,labNumber,fingerprint,runId,datetime.now()])
+
+    def invalidateStages(self, stage=None, labNumber=None):
+        # Mark cached stages (all of them, those whose names start with stage, and/or those for one lab) out of date, so that they run again next time.
+        self.cursor.execute("UPDATE stageCache SET fingerprint = NULL WHERE (? IS NULL OR stage LIKE ?) AND (? IS NULL OR labNumber = ?)",[stage,(stage or '')+'%',labNumber,labNumber])
+        self.conn.commit()
+
+    def listStageCache(self, labNumber=None):
+        # [stage, labNumber, fingerprint, runId, time] for every cached stage, optionally only those for one lab
+        self.cursor.execute("SELECT stage, labNumber, fingerprint, runId, time FROM stageCache WHERE (? IS NULL OR labNumber = ?) ORDER BY labNumber, stage",[labNumber,labNumber])
+        return [list(entry) for entry in self.cursor.fetchall()]
+
+    def getChanges(self, consumer, labNumber):
+        # What consumer (the name of a derived result, starting with the table it's written to, e.g. 'weights weightBIBI 3' for updateWeights) has to recompute for labNumber: (wIDs, changeId), where wIDs lists the reviewers whose studentEvaluations changed since consumer's last setWatermark, or is None if everyone has to be recomputed (first time, or the lab's expert evaluations or rubric changed). Pass changeId to setWatermark once the results are written.
+        self.cursor.execute("SELECT coalesce(max(changeId), 0) FROM evaluationChanges")
+        changeId = self.cursor.fetchone()[0]
+        self.cursor.execute("SELECT changeId FROM changeWatermarks WHERE consumer = ? AND labNumber = ?",[consumer,labNumber])
+        watermark = self.cursor.fetchone()
+        if watermark is None:
+            return None, changeId
+        self.cursor.execute("SELECT count(*) FROM evaluationChanges WHERE labNumber = ? AND changeId > ? AND changeId <= ? AND wIDkey IS NULL",[labNumber,watermark[0],changeId])
+        if self.cursor.fetchone()[0] > 0:
+            return None, changeId
+        self.cursor.execute('''SELECT DISTINCT studentKeys.wID FROM evaluationChanges, studentKeys
+            WHERE evaluationChanges.labNumber = ? AND changeId > ? AND changeId <= ? AND studentKeys.wIDkey = evaluationChanges.wIDkey
+            ORDER BY studentKeys.wID''',[labNumber,watermark[0],changeId])
+        return [entry[0] for entry in self.cursor.fetchall()], changeId
+
+    def setWatermark(self, consumer, labNumber, changeId):
+        # Record that consumer is up to date with every change up to changeId. Doesn't commit; do it in the same transaction as the results.
+        self.cursor.execute("INSERT OR REPLACE INTO changeWatermarks(consumer,labNumber,changeId) VALUES (?,?,?)",[consumer,labNumber,changeId])
+        # so that the next change to the latest entry's reviewer is logged again, rather than taken for part of the change consumer has seen
+        self.cursor.execute("INSERT INTO evaluationChanges(labNumber,wIDkey) VALUES (NULL,NULL)")
+
+    def recordManifest(self, tableName, filename, thisHash, runId, labNumber=None):
+        # Record that filename (with hash thisHash) wrote the rows of tableName tagged with runId. Doesn't commit.
+        self.cursor.execute("SELECT count(*), min(row), max(row) FROM "+self.runRows(tableName)+" WHERE runId = ?",[runId])
+        nRows, firstRow, lastRow = self.cursor.fetchone()
+        self.cursor.execute("INSERT OR REPLACE INTO ingestManifest(row,time,tableName,filename,labNumber,fileHash,runId,firstRow,lastRow,nRows) VALUES (NULL,?,?,?,?,?,?,?,?,?)",
+            [datetime.now(), tableName, os.path.abspath(filename), labNumber, thisHash, runId, firstRow, lastRow, nRows])
+
+    def clearManifest(self, tableName=None, labNumber=None):
+        # Forget ingested files (all of them, or just those for one table and/or lab) so that they'll be ingested again. Use this after deleting rows by hand.
+        self.cursor.execute("DELETE FROM ingestManifest WHERE (? IS NULL OR tableName = ?) AND (? IS NULL OR labNumber = ?)",[tableName, tableName, labNumber, labNumber])
+        self.conn.commit()
+
+    def addStudentSubmission(self,wID,youtubeURL,labNumber,URL=None,term='SOUP2016',runId=None):
         # Try to add a single student's URL submission. Flags the appropriate entry when the student already submitted a URL that lab, or if the URL already exists
         successState = False
 
         try:
-            self.cursor.execute('''INSERT INTO submissions(row,time,term,wID,labNumber,URL,youtubeURL) VALUES (NULL,?,?,?,?,?,?)''',
-            [datetime.now(),term,wID,labNumber,URL,youtubeURL])
+            afterRow = self.getMaxRow('submissions')
+            self.cursor.execute('''INSERT INTO submissions(row,time,term,wID,labNumber,URL,youtubeURL) VALUES (NULL,NULL,?,?,?,?,?)''',
+            [term,wID,labNumber,URL,youtubeURL])
+            if runId is not None:
+                self.stampRun('submissions', runId, afterRow)
             successState = True
         except sqlite3.IntegrityError as error:
 
@@ -441,48 +1126,91 @@ class SWAPRdb:
             (SELECT DISTINCT wID FROM students GROUP BY wID, term HAVING count(wID) >1)''')
         
 
-    def parseSubmissions(self,inputFile,labNumber,verbose=False,wIDcol=1,linkCol=4, term='SOUP2016'):
+    def parseSubmissions(self,inputFile,labNumber,verbose=False,wIDcol=1,linkCol=4, term='SOUP2016', skipUnchanged=True):
         # Reads a Webassign-formatted tab-delimited .csv file containing YouTube links submitted by students.
         #
         # When you download the .csv file, you must inclide the student responses, not just their scores. Scores are optional; the parser knows to ignore them.
+        #
+        # Files already in the ingest manifest are skipped if they haven't changed; if they have, their old rows are replaced.
+        #
+        # The whole file is staged in a temporary table and loaded with set-based SQL instead of one addStudentSubmission() per line. The outcome is the same as adding the lines one at a time: the first submission wins, and the existing row is flagged '>1 URL this lab' when a student submits again, or 'duplicate URL' when someone resubmits an existing URL. Returns a summary of what was added and flagged (nothing, if the file is skipped).
 
-        data = []
-        with open(inputFile, 'rU') as csvfile:
+        self.cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS submissionStaging
+            (seq INTEGER PRIMARY KEY NOT NULL,
+                wID text,
+                URL text,
+                youtubeURL text,
+                nExisting int,
+                nExistingURL int)
+            ''')
+        self.cursor.execute('DELETE FROM submissionStaging')
+
+        filename = inputFile
+        thisHash, skip = self.checkManifest('submissions', filename, skipUnchanged)
+        if skip:
+            print('Skipping unchanged '+filename)
+            return {'added': 0, '>1 URL this lab': [], 'duplicate URL': []}
+        runId = self.beginRun('parseSubmissions', labNumber, term, filename)
+        with openCSV(inputFile) as csvfile:
             inputFile = csv.reader(csvfile, delimiter='\t', quotechar='"')
-            # TODO: change this to operate directly on the file itself, not just blindly copy the whole file into memory
-            for row in inputFile:
-                data.append(row)
-
-        line = 0
-        foundStart = False
-        while not foundStart:    #Seek out the first line of student data
-            if len(data[line]) >= 1:
-                if data[line][0] == 'Fullname': # The data starts right after the header line beginning with 'Fullname'
-                    foundStart = True
-            line = line+1
-
-
-        # Go through the data line-by-line, and add students + URLs to the database
-        while line in range(len(data)):
-            if len(data[line]) > 1: # Make sure we don't have a blank line
-                if data[line][0] != '': # Make sure we don't have one of the score lines
-                    wID=data[line][wIDcol]
-                    youtubeURL=getYoutubeLink(data[line][linkCol])
-                    if youtubeURL not in ['',None]:
-                        # if skipLinkless, then we won't add people who haven't submitted links
-                        if verbose:
-                            print('Adding submission: wID='+wID+', URL='+youtubeURL+', labNumber='+str(labNumber))
-                        if youtubeURL == '':
-                            youtubeURL = None
-                        self.addStudentSubmission(wID,youtubeURL,labNumber,term=term)
-            line += 1
+            for row in inputFile:    #Seek out the first line of student data
+                if len(row) >= 1 and row[0] == 'Fullname': # The data starts right after the header line beginning with 'Fullname'
+                    break
+            self.cursor.executemany('INSERT INTO submissionStaging(seq,wID,URL,youtubeURL) VALUES (NULL,?,?,?)', iterSubmissionRows(inputFile, labNumber, wIDcol, linkCol, verbose))
+
+        # Count the submissions that were already there, before we add any
+        self.cursor.execute('''UPDATE submissionStaging SET
+            nExisting = (SELECT count(*) FROM submissions WHERE submissions.wID = submissionStaging.wID AND submissions.labNumber = ?),
+            nExistingURL = (SELECT count(*) FROM submissions WHERE submissions.URL = submissionStaging.URL)''',[labNumber])
+        # In seq order, so a line only conflicts with the lines before it, just like adding them one at a time
+        afterRow = self.getMaxRow('submissions')
+        self.cursor.execute('''INSERT OR IGNORE INTO submissions(row,time,term,wID,labNumber,URL,youtubeURL)
+            SELECT NULL, NULL, ?, wID, ?, URL, youtubeURL FROM submissionStaging ORDER BY seq''',[term,labNumber])
+        nAdded = self.cursor.rowcount
+        self.stampRun('submissions', runId, afterRow)
+        self.endRun(runId, nAdded)
+
+        # student already submitted this lab
+        self.cursor.execute('''UPDATE submissions SET flag = '>1 URL this lab'
+            WHERE labNumber = ? AND wID IN
+                (SELECT wID FROM submissionStaging GROUP BY wID HAVING count(*) + max(nExisting) > 1)''',[labNumber])
+        self.cursor.execute('''SELECT wID, row FROM submissions
+            WHERE labNumber = ? AND wID IN
+                (SELECT wID FROM submissionStaging GROUP BY wID HAVING count(*) + max(nExisting) > 1)
+            ORDER BY wID''',[labNumber])
+        multipleURLs = [[str(entry[0]), int(entry[1])] for entry in self.cursor.fetchall()]
+        # URL has already been submitted
+        self.cursor.execute('''UPDATE submissions SET flag = 'duplicate URL'
+            WHERE URL IN
+                (SELECT URL FROM submissionStaging WHERE URL IS NOT NULL GROUP BY URL HAVING count(*) + max(nExistingURL) > 1)''')
+        self.cursor.execute('''SELECT URL, row FROM submissions
+            WHERE URL IN
+                (SELECT URL FROM submissionStaging WHERE URL IS NOT NULL GROUP BY URL HAVING count(*) + max(nExistingURL) > 1)
+            ORDER BY URL''')
+        duplicateURLs = [[str(entry[0]), int(entry[1])] for entry in self.cursor.fetchall()]
+
+        self.recordManifest('submissions', filename, thisHash, runId, labNumber)
         self.conn.commit()
 
-    def parseExpertEvaluations(self,filename,term='F2014',wIDcol=1):
+        print('Added '+str(nAdded)+' submissions for Lab '+str(labNumber)+' from '+filename)
+        for wID, row in multipleURLs:
+            print('WARNING: '+wID+' attempted to submit more than one URL for Lab '+str(labNumber)+'; flagged row '+str(row))
+        for URL, row in duplicateURLs:
+            print('WARNING: '+URL+' was submitted more than once; flagged row '+str(row))
+        return {'added': nAdded, '>1 URL this lab': multipleURLs, 'duplicate URL': duplicateURLs}
+
+    def parseExpertEvaluations(self,filename,term='F2014',wIDcol=1,skipUnchanged=True):
         # We write the experts file ourselves, so we use a less irritating format than the WebAssign .csv's we have to use for the student data
         data = []
         reportEntries = []
-        with open(filename, 'rU') as csvfile:
+        thisHash, skip = self.checkManifest('expertEvaluations', filename, skipUnchanged)
+        if skip:
+            print('Skipping unchanged '+filename)
+            return reportEntries
+        runId = self.beginRun('parseExpertEvaluations', term=term, source=filename)
+        afterRow = self.getMaxRow('expertEvaluations')
+        nRows = 0
+        with openCSV(filename) as csvfile:
             inputFile = csv.reader(csvfile, delimiter='\t', quotechar='|')
             for row in inputFile:
                 data.append(row)
@@ -499,8 +1227,12 @@ class SWAPRdb:
                     itemIndex = data[line][4]
                     rating = data[line][5]
                     comment = data[line][6]
-                    self.cursor.execute("INSERT INTO expertEvaluations(row,time,term,labNumber,videoLabel,URL,vidOrder,itemIndex,rating,comment) VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [datetime.now(), term, labNumber, label, URL, order, itemIndex, rating, comment])
+                    self.cursor.execute("INSERT INTO expertEvaluations(row,time,term,labNumber,videoLabel,URL,vidOrder,itemIndex,rating,comment) VALUES (NULL, NULL, ?, ?, ?, ?, ?, ?, ?, ?)", [term, labNumber, label, URL, order, itemIndex, rating, comment])
+                    nRows += 1
             line += 1
+        self.stampRun('expertEvaluations', runId, afterRow)
+        self.endRun(runId, nRows)
+        self.recordManifest('expertEvaluations', filename, thisHash, runId)
         self.conn.commit()
         return reportEntries
         
@@ -513,10 +1245,7 @@ class SWAPRdb:
             return [str(i[0]) for i in dbExtract]
 
     def exportWebassign(self,filename,labNumber):
-
-        self.cursor.execute("SELECT DISTINCT wID FROM assignments WHERE labNumber = ?",[labNumber])
-        wIDs = [str(item[0]) for item in self.cursor.fetchall()]
-
+        # The lab's assignments come from one query, in wID order, and are written out a student at a time. A list of links that's the same as an earlier student's (e.g. the 'default' set) isn't written again: the first student with it saves it as $linkset[n] (Perl evaluates the %linkdb list left to right), and the rest refer to that.
         self.cursor.execute("SELECT count(DISTINCT URL) FROM expertEvaluations WHERE labNumber = ? AND videoLabel NOT LIKE 'Hidden%'",[labNumber])
         evalStartIndex = int(self.cursor.fetchone()[0]) # The webassign evaluation assignment will contain URLs from getURLsToGrade starting with the evalStartIndex-th entry; this excludes the practice and unhidden calibration videos
         # print('evalStartIndex='+str(evalStartIndex))
@@ -526,9 +1255,16 @@ class SWAPRdb:
                 '#!/usr/bin/env perl\n'
                 '%linkdb = (\n')
 
-            for wID in wIDs:
-                # if self.getURL(wID,labNumber) not in ['',None]:
-                output.write(getPerlLinksLine(wID,self.getURLsToGrade(wID,labNumber)[evalStartIndex:]))
+            self.cursor.execute("SELECT wID, URL FROM assignments WHERE labNumber = ? ORDER BY wID, questionIndex",[labNumber])
+            linkSets = {}   # sha1 of the list: its n in $linkset[n]
+            for wID, entries in groupby(self.cursor, lambda entry: entry[0]):
+                links = getPerlLinksList([str(entry[1]) for entry in entries][evalStartIndex:])
+                key = hashlib.sha1(links.encode('utf-8')).digest()
+                if key in linkSets:
+                    output.write('\t\"' + perlPerson(str(wID)) + '\"=> $linkset[' + str(linkSets[key]) + '],\n')
+                else:
+                    linkSets[key] = len(linkSets)
+                    output.write('\t\"' + perlPerson(str(wID)) + '\"=> ($linkset[' + str(linkSets[key]) + '] = ' + links + '),\n')
             output.write(');\n\n')
 
             output.write('sub get_link {\n'
@@ -549,9 +1285,8 @@ class SWAPRdb:
             # output.write('<b>Please watch and respond to the following video:</b> <a href=http://youtu.be/<EQN>get_link($this_student,$QUESTION_NUM-1);</EQN> target="_blank"><eqn get_link($this_student,$QUESTION_NUM-1);></a> (This might be your own video; if so, please grade it honestly!)\n<br><br>\n\n')
 
 
-    def assignURLs(self,labNumber,Npeer=3,term='F2014'):
-        # construct a list of all wID, URL pairs for every submission in this lab, ordered by URL (this ends up being pseudorandom)
-        # students who DID NOT submit their own URL this lab will all be assigned the same set of URLs to evaluate. This set will also be assigned to exactly one student who DID submit their own URL. Thus, each URL will be assigned to AT LEAST Npeer students, Npeer of whom DID submit their own URL for that lab.
+    def getAssignmentSources(self, labNumber):
+        # The lab's (wID, URL) submissions in URL order, and its practice, shown and hidden expert URLs, for assignURLs and assignLateSubmissions
         self.cursor.execute("SELECT DISTINCT wID, URL FROM submissions WHERE labNumber = ? AND URL IS NOT NULL ORDER BY URL",[labNumber])
         submissionList = [[str(entry[0]),str(entry[1])] for entry in self.cursor.fetchall()]
 
@@ -566,237 +1301,310 @@ class SWAPRdb:
         # expert URLs to be hidden among the peer URLs
         self.cursor.execute("SELECT DISTINCT URL FROM expertEvaluations WHERE labNumber = ? AND videoLabel = 'Hidden Calibration'",[labNumber])
         hiddenList = [str(entry[0]) for entry in self.cursor.fetchall()]
+        return submissionList, practiceList, shownList, hiddenList
 
-        # URL assignment for every student who submitted a video
-        for i in range(len(submissionList)):
-            URLsToGrade = []
-            wID = submissionList[i][0]
-
-            # add all the hidden expert URLs
-            for URL in hiddenList:
-                URLsToGrade.append(URL)
-
-            j = 0
-            while len(URLsToGrade) < Npeer + len(hiddenList) + 1: # the +1 is for the student's own video
-                # add the student's own URL and the next Npeer URLs, wrapping around to the beginning of the list, skipping over URLs when they're already present in URLsToGrade. Will fail if len(submissionList) <= Npeer
-                thisURL = submissionList[(i+j)%len(submissionList)][1]
-                if thisURL not in URLsToGrade:
-                    URLsToGrade.append(submissionList[(i+j)%len(submissionList)][1])
-                j += 1
-                # safety valve
-                if j > len(submissionList):
-                    break
-            random.seed(wID)
-            random.shuffle(URLsToGrade)
+    def assignURLs(self,labNumber,Npeer=3,term='F2014',solver=False,hiddenPerStudent=None):
+        # construct a list of all wID, URL pairs for every submission in this lab, ordered by URL (this ends up being pseudorandom)
+        # students who DID NOT submit their own URL this lab will all be assigned the same set of URLs to evaluate. This set will also be assigned to exactly one student who DID submit their own URL. Thus, each URL will be assigned to AT LEAST Npeer students, and exactly Npeer of the students who DID submit their own URL for that lab (besides its owner).
+        # All the lists are built in one pass over the lab's submissions (see ringAssignments) and written with executemany.
+        # With solver=True, the ring is also arranged so that students review as few of their own section as possible, nobody reviews someone who reviews them, and, with hiddenPerStudent, each student gets that many of the hidden expert URLs, spread evenly over them (see solverAssignments). A report of how well that worked is printed.
+        submissionList, practiceList, shownList, hiddenList = self.getAssignmentSources(labNumber)
+
+        # every submitted URL goes in the ring, in URL order (which ends up being pseudorandom), except any hidden expert URLs, which everyone gets anyway. Their submitters get the 'default' set.
+        hidden = set(hiddenList)
+        ring = []
+        owners = []
+        for wID, URL in submissionList:
+            if URL in hidden:
+                print('WARNING: '+wID+' submitted the hidden calibration URL '+URL+', so they get the default set')
+            else:
+                ring.append(URL)
+                owners.append(wID)
+
+        if solver:
+            start = datetime.now()
+            self.cursor.execute("SELECT wID, section FROM students ORDER BY row")
+            sections = dict(self.cursor.fetchall())   # the latest, for students who changed sections
+            peerLists, report = solverAssignments(ring, owners, sections, Npeer, hiddenList, hiddenPerStudent)
+            hiddenList = []
+            printAssignmentReport(report, (datetime.now() - start).total_seconds())
+        else:
+            peerLists = ringAssignments(ring, owners, Npeer)
 
-            # add the practice and then the shown URLs, in order, at the beginning
-            URLsToGrade = practiceList + shownList + URLsToGrade
+        runId = self.beginRun('assignURLs', labNumber, term)
+        rows = iterAssignmentRows(peerLists, practiceList, shownList, hiddenList, term, labNumber, runId)
+        nRows = self.insertRows('assignments', assignmentsColumns, rows)
+        self.endRun(runId, nRows)
+        self.conn.commit()
 
-            for j in range(len(URLsToGrade)):
-                self.cursor.execute("INSERT INTO assignments(row,time,term,labNumber,wID,questionIndex,wQuestion,videoLabel,URL) VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?)",[datetime.now(),term,labNumber,wID,j+1,None,None,URLsToGrade[j]])
-        # repeat the last set of URLsToGrade as the default set for students who didn't submit a video.
-        for j in range(len(URLsToGrade)):
-            self.cursor.execute("INSERT INTO assignments(row,time,term,labNumber,wID,questionIndex,wQuestion,videoLabel,URL) VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?)",[datetime.now(),term,labNumber,'default',j+1,None,None,URLsToGrade[j]])
+    def assignLateSubmissions(self,labNumber,Npeer=None,term='F2014',overflow=1):
+        # Give URLs to grade to students who submitted after assignURLs ran, without touching anyone else's assignments; only new rows are written.
+        # Each late student gets a list shaped like most students' (Npeer, if not given, and the number of hidden expert URLs are read off it): their own URL and the Npeer URLs with the fewest peer reviewers so far, which puts the late URLs, with none, first. A late URL still short of Npeer reviewers is added to the end of the lists of students with the most spare capacity, and failing that, to the end of the default set.
+        # Since assignURLs gives everyone a list of the same length, there's usually no spare capacity, so students' lists may grow up to overflow URLs past the usual length. A URL past the number of questions in a student's WebAssign evaluation assignment is never shown to them, so when that happens, add as many questions to the assignment (and to the default set's).
+        submissionList, practiceList, shownList, hiddenList = self.getAssignmentSources(labNumber)
+        hidden = set(hiddenList)
+        self.cursor.execute("SELECT wID, URL FROM assignments WHERE labNumber = ? ORDER BY wID, questionIndex",[labNumber])
+        lists = {}
+        for wID, URL in self.cursor.fetchall():
+            lists.setdefault(str(wID), []).append(str(URL))
+        default = lists.pop('default', None)
+        if lists == {}:
+            print('No assignments for lab '+str(labNumber)+' yet; use assignURLs')
+            return
+        late = [(wID, URL) for wID, URL in submissionList if wID not in lists and URL not in hidden]
+        if late == []:
+            print('No late submissions for lab '+str(labNumber))
+            return
+        # the usual list (the default set may have grown from earlier calls)
+        lengths = {}
+        for URLs in lists.values():
+            lengths[len(URLs)] = lengths.get(len(URLs), 0) + 1
+        usualLength = max(lengths, key=lambda length: (lengths[length], -length))
+        template = [URLs for URLs in lists.values() if len(URLs) == usualLength][0]
+        nHidden = len([URL for URL in template if URL in hidden])
+        if Npeer is None:
+            Npeer = len(template) - len(practiceList) - len(shownList) - nHidden - 1
+
+        # how many peers (besides its owner) each URL has so far
+        owner = dict((URL, wID) for wID, URL in submissionList)
+        reviews = dict((URL, 0) for wID, URL in submissionList if URL not in hidden)
+        hiddenReviews = dict((URL, 0) for URL in hiddenList)
+        for wID, URLs in lists.items():
+            for URL in URLs:
+                if URL in reviews and owner[URL] != wID:
+                    reviews[URL] += 1
+                elif URL in hiddenReviews:
+                    hiddenReviews[URL] += 1
+
+        # each late student reviews the Npeer least-reviewed URLs other than their own
+        heap = [(count, URL) for URL, count in reviews.items()]
+        heapq.heapify(heap)
+        peerLists = []
+        for wID, ownURL in late:
+            picked = []
+            skipped = []
+            while len(picked) < Npeer and heap != []:
+                count, URL = heapq.heappop(heap)
+                if URL == ownURL:
+                    skipped.append((count, URL))
+                else:
+                    picked.append(URL)
+            for URL in picked:
+                reviews[URL] += 1
+                heapq.heappush(heap, (reviews[URL], URL))
+            for entry in skipped:
+                heapq.heappush(heap, entry)
+            hiddenURLs = sorted(hiddenList, key=lambda URL: (hiddenReviews[URL], URL))[:nHidden]
+            for URL in hiddenURLs:
+                hiddenReviews[URL] += 1
+            peerLists.append((wID, hiddenURLs + [ownURL] + picked))
+
+        runId = self.beginRun('assignLateSubmissions', labNumber, term)
+        rows = list(iterAssignmentRows(peerLists, practiceList, shownList, [], term, labNumber, runId, defaultSet=False))
+
+        # late URLs still short of reviewers go to the students (late ones too) with the most spare capacity, up to overflow past the usual length, and then to the default set
+        for row in rows:
+            lists.setdefault(row[2], []).append(row[6])
+        maxLength = len(template) + overflow
+        capacity = [(len(URLs) - maxLength, wID) for wID, URLs in lists.items() if len(URLs) < maxLength]
+        heapq.heapify(capacity)
+        for wID, URL in late:
+            skipped = []
+            while reviews[URL] < Npeer and capacity != []:
+                spare, reviewer = heapq.heappop(capacity)
+                if reviewer == wID or URL in lists[reviewer]:
+                    skipped.append((spare, reviewer))
+                    continue
+                lists[reviewer].append(URL)
+                rows.append((term, labNumber, reviewer, len(lists[reviewer]), None, None, URL, runId))
+                reviews[URL] += 1
+                if spare + 1 < 0:
+                    heapq.heappush(capacity, (spare + 1, reviewer))
+            for entry in skipped:
+                heapq.heappush(capacity, entry)
+            if reviews[URL] < Npeer and default is not None and URL not in default:
+                default.append(URL)
+                rows.append((term, labNumber, 'default', len(default), None, None, URL, runId))
+                print('Added '+URL+' to the default set, since it only has '+str(reviews[URL])+' peer reviewers')
+
+        nRows = self.insertRows('assignments', assignmentsColumns, rows)
+        self.endRun(runId, nRows)
         self.conn.commit()
+        print('Assigned '+str(len(late))+' late submissions for lab '+str(labNumber)+' ('+str(nRows)+' rows)')
+        longest = max(len(URLs) for URLs in lists.values())
+        if longest > len(template):
+            print('WARNING: '+str(len([URLs for URLs in lists.values() if len(URLs) > len(template)]))+' students now have up to '+str(longest)+' URLs to grade, more than the usual '+str(len(template))+'; URLs past the number of questions in the WebAssign evaluation assignment are never shown, so give it (and the default set) '+str(longest)+' questions')
 
-    def parseEvaluationsFile(self,filename,labNumber,term='F2014',wIDcol=1):
+    def parseEvaluationsFile(self,filename,labNumber,term='F2014',wIDcol=1,batchSize=5000,assignmentMap=None,verbose=False,skipUnchanged=True,commit=True):
         # parse student responses from the associated Webassign .csv file. As of October 2013, there are 3 such files associated with each lab; a practice file and a calibration file which each contains only fixed expert-graded URLs, and an evaluation file containing shuffled student URLs, the student's own URL, and one expert URL.
 
         # Regardless of which file we feed it, this function matches the student's responses up with the appropriate URL by mapping the given Webassign Question ID to that response's question index, and then mapping the question index to that student's URLsToGrade
-        data = []
-        R = self.getNgradedItems(labNumber)
-        with open(filename, 'rU') as csvfile:
-            inputFile = csv.reader(csvfile, delimiter='\t', quotechar='|')
-            for row in inputFile:
-                data.append(row)
 
+        # The file is streamed one line at a time, and the studentEvaluations rows are written batchSize at a time inside a single transaction, so memory use doesn't grow with the size of the export.
 
-            line = 0
-
-            questions = []
-            foundStart = False
-
-            questionCols = {}   # a dictionary of {column: wQuestion} which shows which column corresponds to the start of the responses to which wQuestion
-            isMultistep = False
-            # New feature as of Lab 3 S2014; students can flag assignments as unwatchable, with the following error cordes: 0) No error; 1) Video is private, missing, or unavailable; 2) Profound technical problems like missing audio; 3) This video isn't the one the presenter intended to upload
-            # NEW new feature as of SOUP 2016; we've dispensed with the multistep problems, they were too complicated for their own good.
-            isFlaggable = False
-            isScaffold = False
-            # Multistep questions are NEVER flaggable
-            while not foundStart:    #Seek out the first line of student data
-                if len(data[line]) >= 1:
-                    # If this file is from a practice or calibration assignment, then the responses are 2-step
-                    if data[line][0] == 'Assignment Name':
-                        for word in data[line][1].split(' '):
-                            if word in ['Practice']:
-                                # isMultistep = True
-                                isScaffold = True
-                                print(filename+" is a scaffold assignment.")
-                            elif word in ['Evaluation']:
-                                isFlaggable = True
-                                print(filename+" is a flaggable assignment.")
-                    if data[line][0] == "Questions":
-                        for entry in data[line]:
-                            if re.match('[0-9]',entry):    # Check to see if we've got a question number
-                                questionCols.update({data[line].index(entry): int(entry)})
-                                questions.append(int(entry))
-                    if data[line][0] == 'Fullname':
-                        foundStart = True
-                line = line+1
-                # print(questionCols)
-
-            # Down in the student grade data, now
-            while line in range(len(data)):
-                if len(data[line]) > 1: # Make sure we don't have a blank line
-                    if data[line][0] != '': # Make sure we don't have one of the score lines
-                        # Now we have a student in the grade file; find the right student in self
-                        wID = data[line][wIDcol]
-                        fullName = data[line][0]
-                        # print("Parsing responses for "+wID+'...')
-
-                        # Now we see if this is line is from a multipart practice, disclosed) question or not (peer, self, hidden)
-
-
-
-                        for qStart in questionCols.keys():  # go over every question
-                            # qStart = colNum  # this question starts at this column
-                            j = 0
-                            wQuestion = questionCols[qStart]
-                            # self.cursor.execute("SELECT assignments.URL FROM assignments, questions WHERE assignments.questionIndex = questions.questionIndex AND questions.wQuestion = ? AND assignments.labNumber = questions.labNumber AND assignments.labNumber = ? AND assignments.wID = ?",[wQuestion,labNumber, wID]) # Pre-F2014
-                            self.cursor.execute("SELECT assignments.URL, assignments.videoLabel FROM assignments WHERE assignments.wQuestion = ? AND assignments.labNumber = ? AND assignments.wID = ?",[wQuestion,labNumber, wID])
-
-
-                            try:
-                                URL, videoLabel = self.cursor.fetchone()
-                            # If the student didn't submit a URL themselves, then they got the 'default' URL assignments
-                            except:
-                                # self.cursor.execute("SELECT assignments.URL FROM assignments, questions WHERE assignments.questionIndex = questions.questionIndex AND questions.wQuestion = ? AND assignments.labNumber = questions.labNumber AND assignments.labNumber = ? AND assignments.wID = ?",[wQuestion,labNumber, 'default']) # Pre-F2014
-                                self.cursor.execute("SELECT assignments.URL FROM assignments WHERE assignments.wQuestion = ? AND assignments.labNumber = ? AND assignments.wID = ?",[wQuestion,labNumber, 'default'])
-                                URL = self.cursor.fetchone()
-                                videoLabel = 'Peer Evaluation'
-                                try:
-                                    URL = str(URL[0])
-                                except:
-                                    print('Response has invalid URL: URL='+str(URL)+', wID='+wID+', wQuestion='+str(wQuestion))
-                            # Break the line up into chunks of KNOWN LENGTH starting at colNum
-                            # TODO: This is messy; info about the structure of the WebAssign question should be encoded into the rubric
-
-                            # As of 5Mar2013, the practice + disclosed calibration videos have 2 steps; the first step has R graded numerical responses + 1 ungraded numerical response, and the second step has R sequential graded numerical/ungraded comment pairs and then 1 ungraded numerical response.
-
-                            # As of 27Mar2013, the evaluation questions also include a numerical error response at the very end.
-
-                            # First, get the responses for the first step
-                            if isMultistep:
-                                firstStepResponses = {}
-                                lenFirstStep = R+1
-                                for i in range(lenFirstStep):
-                                    itemIndex = 2*i + 1 # the first step has no comments
-                                    response = data[line][i+qStart]
-                                    # blank responses should be Nones, not empty strings
-                                    if response == '':
-                                        response = None
-                                    firstStepResponses.update({itemIndex: response})
-
-                                # Now for the second (confirmation) step
-                                secondStepResponses = {}
-                                lenSecondStep = 2*R + 1
-                                for i in range(lenSecondStep):
-                                    itemIndex = i + 1 # second step has comments
-                                    try:
-                                        response = data[line][i + lenFirstStep + qStart]
-                                    except:
-                                        print('lenSecondStep = '+str(lenSecondStep))
-                                        print('qStart = '+str(qStart))
-                                        print('column = '+str(i + lenFirstStep + qStart))
-
-                                    # blank responses should be Nones, not empty strings
-                                    if response == '':
-                                        response = None
-                                    secondStepResponses.update({itemIndex: response})
-
-                                # We take the second step responses. If any of those numerical responses are blank, then we use the corresponding response from the first step
-                                finalResponses = {}
-                                for itemIndex in secondStepResponses.keys():
-                                    if secondStepResponses[itemIndex] == None:
-                                        try:
-                                            finalResponses.update({itemIndex: firstStepResponses[itemIndex] })
-                                        except KeyError:
-                                            finalResponses.update({itemIndex: None})
-                                    else:
-                                        finalResponses.update({itemIndex: secondStepResponses[itemIndex]})
-                            else:
-                                finalResponses = {}
-                                if isFlaggable:
-                                # If the question is a flaggable question, then the final (non-graded) numerical response also has a comment.
-                                    for i in range(2*(R + 1)):
-                                        # if line == 20 or line == 21:
-                                            # print('Line '+str(line+1)+' Length '+str(len(data[line])))
-                                            # print('i '+str(i))
-                                            # print(data[line])
-                                        itemIndex = i + 1
-                                        response = data[line][i + qStart]
-                                        finalResponses.update({itemIndex: response})
-                                    try:
-                                        flag = int(data[line][qStart + i + 1])
-                                    except:
-                                        flag = None
-                                        # Flags not properly implemented
-                                        # self.cursor.execute('''INSERT INTO flags VALUES (NULL, ?, ?, ?, ?)''',[labNumber, wID, URL, flag])
-                                if isScaffold:
-                                # If the question is a scaffold question, the final (non-graded) numerical response does not have a comment.
-                                    for i in range(2*R + 1):
-                                        # if line == 20 or line == 21:
-                                            # print('Line '+str(line+1)+' Length '+str(len(data[line])))
-                                            # print('i '+str(i))
-                                            # print(data[line])
-                                        itemIndex = i + 1
-                                        response = data[line][i + qStart]
-                                        finalResponses.update({itemIndex: response})
-
-
-
-                            # print('Response: '+wID+' '+URL+' '+str(finalResponses))
-                            # print('First Response: '+str(firstStepResponses))
-                            # print('Second Response: '+str(secondStepResponses))
-                            # 1/0
-
-                            # Now we need to refactor finalResponses to separate the rating and the comment
-                            refactoredResponses = {}
-                            for itemIndex in finalResponses.keys():
-                                if itemIndex%2 == 1:
-                                    realItemIndex=(itemIndex+1)/2
-                                    try:
-                                        comment = finalResponses[itemIndex+1]
-                                    except:
-                                        comment = None
-                                    refactoredResponses.update({realItemIndex:[finalResponses[itemIndex],comment]})
-
-                            for itemIndex in refactoredResponses.keys():
-                                rating = refactoredResponses[itemIndex][0]
-                                comment = refactoredResponses[itemIndex][1]
-                                # try:
-                                self.cursor.execute("INSERT INTO studentEvaluations VALUES(NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [datetime.now(), term, wID, labNumber, URL, videoLabel, itemIndex, None, rating, comment])
-                                # except:
-                                #     print("Non-Unicode string in "+filename+" line "+str(line)+' '+comment)
-
-                line += 1
-            self.conn.commit()
+        # The URL lookups come from an in-memory copy of the lab's assignments (see getAssignmentMap), so a whole file costs 2 queries, no matter how many students and questions it has. Pass in assignmentMap to share one copy between several files.
+
+        # Files already in the ingest manifest are skipped if they haven't changed; if they have, their old rows are replaced.
 
-    def addRubricItem(self, term, labNumber, itemIndex, topic, body=None, graded=True, itemValues = []):
-        self.cursor.execute("INSERT INTO rubrics VALUES (NULL, ?, ?, ?, ?, ?, ?, ?)", [datetime.now(), term, labNumber, itemIndex, topic, body, graded])
+        # With commit=False, the caller commits (e.g. ingestEvaluationsDir, to ingest a whole directory in one transaction).
+        thisHash, skip = self.checkManifest('studentEvaluations', filename, skipUnchanged)
+        if skip:
+            print('Skipping unchanged '+filename)
+            return
+        R = self.getNgradedItems(labNumber)
+        if assignmentMap is None:
+            assignmentMap = self.getAssignmentMap(labNumber)
+        runId = self.beginRun('parseEvaluationsFile', labNumber, term, filename)
+        with openCSV(filename) as csvfile:
+            inputFile = csv.reader(csvfile, delimiter='\t', quotechar='|')
+            questionCols, isFlaggable, isScaffold = readEvaluationsHeader(inputFile, filename)
+            rows = iterEvaluationsRows(inputFile, questionCols, isFlaggable, isScaffold, R, assignmentLookup(assignmentMap), runId, term, labNumber, wIDcol)
+            nRows = self.insertRows('studentEvaluations', studentEvaluationsColumns, rows, batchSize)
+        self.endRun(runId, nRows)
+        self.recordManifest('studentEvaluations', filename, thisHash, runId, labNumber)
+        if commit:
+            self.conn.commit()
+        if verbose:
+            print('Added '+str(nRows)+' responses from '+filename)
+
+    def getAssignmentMap(self, labNumber):
+        # Load the lab's whole assignments table in one query, as ({(wID, wQuestion): (URL, videoLabel)}, {wQuestion: URL}); the second dictionary is the 'default' set, for students who didn't submit a URL themselves
+        self.cursor.execute("SELECT wID, wQuestion, URL, videoLabel FROM assignments WHERE labNumber = ?",[labNumber])
+        assigned = {}
+        default = {}
+        for wID, wQuestion, URL, videoLabel in self.cursor.fetchall():
+            if wID == 'default':
+                default[wQuestion] = str(URL)
+            else:
+                assigned[(wID, wQuestion)] = (URL, videoLabel)
+        return assigned, default
+
+    def insertRows(self, tableName, columns, rows, batchSize=5000):
+        # Insert rows (sequences of values for columns) into tableName, batchSize rows at a time (see executeBatches). For a table in keyedTables, the rows go straight into tableNameFact, with their wIDs and URLs swapped for integer keys on the way, rather than through the view's INSTEAD OF trigger, which looks up (and maybe adds) each row's keys with a query of its own. Doesn't commit; returns the number of rows written.
+        storage = self.storageTable(tableName)
+        if storage == tableName:
+            return self.executeBatches("INSERT INTO "+tableName+"("+','.join(columns)+") VALUES ("+','.join(['?']*len(columns))+")", rows, batchSize)
+        factColumns = [keyedColumns[column][0] if column in keyedColumns else column for column in columns]
+        keyed = [(i, column, keyedColumns[column][0], keyedColumns[column][1], {}) for i, column in enumerate(columns) if column in keyedColumns]
+        sql = "INSERT INTO "+storage+"("+','.join(factColumns)+") VALUES ("+','.join(['?']*len(columns))+")"
+        rows = iter(rows)
+        nRows = 0
+        batch = [list(row) for row in islice(rows, batchSize)]
+        while batch:
+            for i, column, key, keyTable, keys in keyed:
+                # the batch's wIDs (or URLs) that haven't been seen yet are added to the key table and looked up together
+                new = list(set(row[i] for row in batch if row[i] is not None and row[i] not in keys))
+                self.cursor.executemany("INSERT OR IGNORE INTO "+keyTable+"("+column+") VALUES (?)", [(value,) for value in new])
+                for start in range(0, len(new), 500):
+                    chunk = new[start:start+500]
+                    self.cursor.execute("SELECT "+column+", "+key+" FROM "+keyTable+" WHERE "+column+" IN ("+','.join(['?']*len(chunk))+")", chunk)
+                    keys.update(self.cursor.fetchall())
+                for value in new:
+                    if value not in keys:   # e.g. a number, which comes back from the text column as a string
+                        self.cursor.execute("SELECT "+key+" FROM "+keyTable+" WHERE "+column+" = ?",[value])
+                        keys[value] = self.cursor.fetchone()[0]
+                for row in batch:
+                    if row[i] is not None:
+                        row[i] = keys[row[i]]
+            self.cursor.executemany(sql, batch)
+            nRows += len(batch)
+            batch = [list(row) for row in islice(rows, batchSize)]
+        return nRows
+
+    def executeBatches(self, sql, rows, batchSize=5000):
+        # executemany() over any iterable of rows, batchSize rows at a time, so that rows can be a generator over an arbitrarily large file. Doesn't commit; returns the number of rows written.
+        rows = iter(rows)
+        nRows = 0
+        batch = list(islice(rows, batchSize))
+        while batch:
+            self.cursor.executemany(sql, batch)
+            nRows += len(batch)
+            batch = list(islice(rows, batchSize))
+        return nRows
+
+    def ingestEvaluationsDir(self, path, labNumber, term='F2014', wIDcol=1, workers=1, batchSize=5000, skipUnchanged=True):
+        # Parse every evaluations file in a directory (e.g. a lab's Responses/ folder), and commit them all in one transaction at the end, or none of them if any file fails.
+        # With workers > 1 (None for one per CPU), the files are parsed in a pool of worker processes, and their rows are funneled back through spool files to this process, which is the only one that writes to the database. A script that does this has to start from an if __name__ == '__main__': block, since on macOS and Windows each worker re-imports it.
+        # Files that are unchanged since they were last ingested are skipped; changed files replace their own rows.
+        files = []
+        hashes = {}
+        for filename in sorted(listdir_nohidden(path)):
+            thisHash, skip = self.checkManifest('studentEvaluations', filename, skipUnchanged)
+            if skip:
+                print('Skipping unchanged '+filename)
+            else:
+                files.append(filename)
+                hashes[filename] = thisHash
+        if files == []:
+            self.conn.commit()
+            return
+        R = self.getNgradedItems(labNumber)
+        assignmentMap = self.getAssignmentMap(labNumber)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = min(workers, len(files))
+        if workers <= 1:
+            try:
+                for filename in files:
+                    print("Parsing "+str(filename)+'...')
+                    self.parseEvaluationsFile(filename, labNumber, term=term, wIDcol=wIDcol, batchSize=batchSize, assignmentMap=assignmentMap, verbose=True, skipUnchanged=False, commit=False)
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+            return
+
+        # one run per file, so that a bad file can be rolled back on its own
+        tasks = [(filename, self.beginRun('parseEvaluationsFile', labNumber, term, filename)) for filename in files]
+        runIds = dict(tasks)
+        pool = multiprocessing.Pool(workers, initEvaluationsWorker, (labNumber, term, wIDcol, R, assignmentMap, batchSize))
+        try:
+            for filename, spoolName in pool.imap_unordered(parseEvaluationsWorker, tasks):
+                nRows = self.insertRows('studentEvaluations', studentEvaluationsColumns, iterSpool(spoolName), batchSize)
+                self.endRun(runIds[filename], nRows)
+                self.recordManifest('studentEvaluations', filename, hashes[filename], runIds[filename], labNumber)
+                print('Added '+str(nRows)+' responses from '+filename)
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+
+    def addRubricItem(self, term, labNumber, itemIndex, topic, body=None, graded=True, itemValues = [], runId=None):
+        # Commits, unless it's given the runId of a caller's run, in which case the caller commits (as addDefaultRubric does)
+        ownRun = runId is None
+        if ownRun:
+            runId = self.beginRun('addRubricItem', labNumber, term)
+        afterRow = self.getMaxRow('rubrics')
+        self.cursor.execute("INSERT INTO rubrics(row,time,term,labNumber,itemIndex,topic,body,graded) VALUES (NULL, NULL, ?, ?, ?, ?, ?, ?)", [term, labNumber, itemIndex, topic, body, graded])
+        self.stampRun('rubrics', runId, afterRow)
         if itemValues != []:
+            afterRow = self.getMaxRow('ratingKeys')
             for i in range(len(itemValues)):
-                self.cursor.execute("INSERT INTO ratingKeys VALUES (NULL, ?,?,?,?,?,?,?)",[datetime.now(), term, labNumber, itemIndex, i, itemValues[i][1], float(itemValues[i][0])])
-        self.conn.commit()
+                self.cursor.execute("INSERT INTO ratingKeys(row,time,term,labNumber,itemIndex,rating,ratingLabel,score) VALUES (NULL, NULL,?,?,?,?,?,?)",[term, labNumber, itemIndex, i, itemValues[i][1], float(itemValues[i][0])])
+            self.stampRun('ratingKeys', runId, afterRow)
+        if ownRun:
+            self.endRun(runId, 1 + len(itemValues))
+            self.conn.commit()
 
 
     def addDefaultRubric(self, labNumber, term='F2014'):
-        self.addRubricItem(labNumber = labNumber, itemIndex = 1, term=term, itemValues= [[11,'Poor'],[15,'Fair'],[17,'Good'],[19,'Very Good'],[20,'Excellent']], topic= 'Organization Structure')
-        self.addRubricItem(labNumber=labNumber, itemIndex = 2, term = term, itemValues=[[11,'Poor'],[15,'Fair'],[17,'Good'],[19,'Very Good'],[20,'Excellent']], topic='Content Models')
-        self.addRubricItem(labNumber=labNumber, itemIndex=3, term=term, itemValues=[[11,'Poor'],[15,'Fair'],[17,'Good'],[19,'Very Good'],[20,'Excellent']], topic='Content Prediction Discussion')
-        self.addRubricItem(labNumber=labNumber, itemIndex=4, term=term, itemValues=[[11,'Poor'],[15,'Fair'],[17,'Good'],[19,'Very Good'],[20,'Excellent']], topic='Content Overall')
-        self.addRubricItem(labNumber=labNumber, itemIndex=5, term=term, itemValues=[[14,'Poor'],[16,'Fair'],[18,'Good'],[19,'Very Good'],[20,'Excellent']], topic='Production Delivery')
-        self.addRubricItem(labNumber=labNumber, itemIndex=6, term=term, itemValues=[[2,'Much better than mine'],[1,'Better than mine'],[0,'As good as mine'],[-1,'Worse than mine'],[-2,'Much worse than mine']], topic='How does this video compare to your video?',graded=False)
+        # The whole rubric goes in one transaction, so a failure part-way doesn't leave half of it behind
+        runId = self.beginRun('addDefaultRubric', labNumber, term)
+        try:
+            self.addRubricItem(labNumber = labNumber, itemIndex = 1, term=term, itemValues= [[11,'Poor'],[15,'Fair'],[17,'Good'],[19,'Very Good'],[20,'Excellent']], topic= 'Organization Structure', runId=runId)
+            self.addRubricItem(labNumber=labNumber, itemIndex = 2, term = term, itemValues=[[11,'Poor'],[15,'Fair'],[17,'Good'],[19,'Very Good'],[20,'Excellent']], topic='Content Models', runId=runId)
+            self.addRubricItem(labNumber=labNumber, itemIndex=3, term=term, itemValues=[[11,'Poor'],[15,'Fair'],[17,'Good'],[19,'Very Good'],[20,'Excellent']], topic='Content Prediction Discussion', runId=runId)
+            self.addRubricItem(labNumber=labNumber, itemIndex=4, term=term, itemValues=[[11,'Poor'],[15,'Fair'],[17,'Good'],[19,'Very Good'],[20,'Excellent']], topic='Content Overall', runId=runId)
+            self.addRubricItem(labNumber=labNumber, itemIndex=5, term=term, itemValues=[[14,'Poor'],[16,'Fair'],[18,'Good'],[19,'Very Good'],[20,'Excellent']], topic='Production Delivery', runId=runId)
+            self.addRubricItem(labNumber=labNumber, itemIndex=6, term=term, itemValues=[[2,'Much better than mine'],[1,'Better than mine'],[0,'As good as mine'],[-1,'Worse than mine'],[-2,'Much worse than mine']], topic='How does this video compare to your video?',graded=False, runId=runId)
+            self.endRun(runId, 6)
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
 
     def getScoresDict(self,labNumber):
         # Construct a dictionary of dictionaries where each possible response is paired with its score for GRADED items only
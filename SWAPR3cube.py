@@ -0,0 +1,183 @@
+from __future__ import division
+from SWAPR3 import *
+import numpy as np
+import json
+import shutil
+
+# A lab's evaluations as dense NumPy arrays, so the weight and grade computations can share one copy instead of each re-running its own SQL scan.
+#
+# A reviewer x video x item array would be mostly empty (each student only sees a dozen or so of the lab's videos), so ratings are stored per reviewer "slot" instead: slot s of reviewer r is the s-th video (in URL order) that r rated, and slotURL[r,s] says which video that is.
+#
+#	ratings[r,s,i]			reviewer r's rating of graded item itemIndices[i] for their s-th video; NaN if missing or not a number
+#	present[r,s,i]			True if there's a studentEvaluations row at all (even a blank one)
+#	slotURL[r,s]			index into URLs of the video in that slot; -1 for unused slots
+#	expertRatings[v,i]		expert rating of video v; NaN if not an expert video, or not a number
+#	expertPresent[v,i]		True if there's an expertEvaluations row
+#	videoKind[v]			NOT_EXPERT, PRACTICE, SHOWN or HIDDEN, from the expert videoLabel
+
+NOT_EXPERT = 0
+PRACTICE = 1	# videoLabel LIKE 'Practice%'
+SHOWN = 2		# any other expert video, e.g. 'Calibration 1'
+HIDDEN = 3		# videoLabel LIKE 'Hidden%'
+
+cubeArrays = ['ratings', 'present', 'slotURL', 'expertRatings', 'expertPresent', 'videoKind']
+
+def toFloat(value):
+	try:
+		return float(value)
+	except:
+		return np.nan
+
+def getVideoKind(videoLabel):
+	label = str(videoLabel).lower()	# LIKE is case-insensitive
+	if label.startswith('practice'):
+		return PRACTICE
+	elif label.startswith('hidden'):
+		return HIDDEN
+	return SHOWN
+
+class EvaluationCube:
+	'''One lab's student and expert evaluations as dense arrays, with index maps for wID, URL and itemIndex'''
+	def __init__(self, labNumber, fingerprint, wIDs, URLs, itemIndices, ratings, present, slotURL, expertRatings, expertPresent, videoKind):
+		self.labNumber = labNumber
+		self.fingerprint = fingerprint
+		self.wIDs = wIDs
+		self.URLs = URLs
+		self.itemIndices = itemIndices
+		self.ratings = ratings
+		self.present = present
+		self.slotURL = slotURL
+		self.expertRatings = expertRatings
+		self.expertPresent = expertPresent
+		self.videoKind = videoKind
+		self.wIDindex = dict((wID, i) for i, wID in enumerate(wIDs))
+		self.URLindex = dict((URL, i) for i, URL in enumerate(URLs))
+		self.itemIndexMap = dict((itemIndex, i) for i, itemIndex in enumerate(itemIndices))
+
+	def slotKind(self):
+		# videoKind of the video in every slot, NOT_EXPERT for unused slots
+		kind = self.videoKind[np.maximum(self.slotURL, 0)]
+		return np.where(self.slotURL >= 0, kind, NOT_EXPERT)
+
+	def slotExpert(self):
+		# (expertRatings, expertPresent) for the video in every slot, shaped like ratings
+		videos = np.maximum(self.slotURL, 0)
+		used = (self.slotURL >= 0)[:, :, np.newaxis]
+		return np.where(used, self.expertRatings[videos], np.nan), used & self.expertPresent[videos]
+
+	def save(self, path):
+		# Write the arrays as .npy files in a new directory path (written next to it first, then renamed into place)
+		tempPath = path+'.tmp'+str(os.getpid())
+		os.makedirs(tempPath)
+		for name in cubeArrays:
+			np.save(os.path.join(tempPath, name+'.npy'), getattr(self, name))
+		with open(os.path.join(tempPath, 'index.json'), 'w') as f:
+			json.dump({'labNumber': self.labNumber, 'fingerprint': self.fingerprint, 'wIDs': self.wIDs, 'URLs': self.URLs, 'itemIndices': self.itemIndices}, f)
+		os.rename(tempPath, path)
+
+def loadCubeFile(path):
+	# Open a cube written by EvaluationCube.save, with the arrays memory-mapped read-only
+	with open(os.path.join(path, 'index.json')) as f:
+		index = json.load(f)
+	arrays = [np.load(os.path.join(path, name+'.npy'), mmap_mode='r') for name in cubeArrays]
+	return EvaluationCube(index['labNumber'], str(index['fingerprint']), [str(wID) for wID in index['wIDs']], [str(URL) for URL in index['URLs']], [int(i) for i in index['itemIndices']], *arrays)
+
+def getCubeCacheDir(db):
+	return os.path.splitext(db.databaseName)[0]+'_cache'
+
+def iterEvaluationRows(db, labNumber, wIDs=None, chunkSize=500):
+	# (wID, URL, itemIndex, rating) for the lab's studentEvaluations, ordered by wID and URL; only those of wIDs, if given
+	if wIDs is None:
+		db.cursor.execute("SELECT wID, URL, itemIndex, rating FROM studentEvaluations WHERE labNumber = ? ORDER BY wID, URL",[labNumber])
+		for entry in db.cursor:
+			yield entry
+		return
+	wIDs = sorted(set(wIDs))
+	for i in range(0, len(wIDs), chunkSize):
+		chunk = wIDs[i:i+chunkSize]
+		db.cursor.execute("SELECT wID, URL, itemIndex, rating FROM studentEvaluations WHERE labNumber = ? AND wID IN ("+','.join(['?']*len(chunk))+") ORDER BY wID, URL",[labNumber]+chunk)
+		for entry in db.cursor.fetchall():
+			yield entry
+
+def buildEvaluationCube(db, labNumber, fingerprint=None, wIDs=None):
+	# One scan of studentEvaluations and one of expertEvaluations for the lab. With wIDs, the cube only has those reviewers (and isn't cached), e.g. to recompute just their weights.
+	db.cursor.execute("SELECT itemIndex FROM rubrics WHERE labNumber = ? AND graded ORDER BY itemIndex",[labNumber])
+	itemIndices = sorted(set([int(entry[0]) for entry in db.cursor.fetchall()]))
+	itemIndexMap = dict((itemIndex, i) for i, itemIndex in enumerate(itemIndices))
+
+	db.cursor.execute("SELECT URL, videoLabel, itemIndex, rating FROM expertEvaluations WHERE labNumber = ? ORDER BY URL",[labNumber])
+	expertData = db.cursor.fetchall()
+
+	rows = iterEvaluationRows(db, labNumber, wIDs)
+	wIDs = []
+	URLindex = {}
+	URLs = []
+	reviewerIndices = []
+	slots = []
+	items = []
+	values = []
+	slotURLs = {}
+	lastwID = lastURL = None
+	slot = -1
+	for wID, URL, itemIndex, rating in rows:
+		if itemIndex not in itemIndexMap:
+			continue
+		if wID != lastwID or wIDs == []:
+			wIDs.append(wID)
+			lastwID = wID
+			lastURL = None
+			slot = -1
+		if URL != lastURL or slot < 0:
+			slot += 1
+			lastURL = URL
+			if URL not in URLindex:
+				URLindex[URL] = len(URLs)
+				URLs.append(URL)
+			slotURLs[(len(wIDs) - 1, slot)] = URLindex[URL]
+		reviewerIndices.append(len(wIDs) - 1)
+		slots.append(slot)
+		items.append(itemIndexMap[itemIndex])
+		values.append(toFloat(rating))
+	for URL, videoLabel, itemIndex, rating in expertData:
+		if URL not in URLindex:
+			URLindex[URL] = len(URLs)
+			URLs.append(URL)
+
+	nSlots = max(slots) + 1 if slots != [] else 0
+	ratings = np.full((len(wIDs), nSlots, len(itemIndices)), np.nan)
+	present = np.zeros(ratings.shape, dtype=bool)
+	ratings[reviewerIndices, slots, items] = values
+	present[reviewerIndices, slots, items] = True
+	slotURL = np.full((len(wIDs), nSlots), -1, dtype=np.int32)
+	for (r, s), v in slotURLs.items():
+		slotURL[r, s] = v
+
+	expertRatings = np.full((len(URLs), len(itemIndices)), np.nan)
+	expertPresent = np.zeros(expertRatings.shape, dtype=bool)
+	videoKind = np.zeros(len(URLs), dtype=np.int8)
+	for URL, videoLabel, itemIndex, rating in expertData:
+		v = URLindex[URL]
+		videoKind[v] = getVideoKind(videoLabel)
+		if itemIndex in itemIndexMap:
+			expertRatings[v, itemIndexMap[itemIndex]] = toFloat(rating)
+			expertPresent[v, itemIndexMap[itemIndex]] = True
+
+	return EvaluationCube(labNumber, fingerprint, wIDs, URLs, itemIndices, ratings, present, slotURL, expertRatings, expertPresent, videoKind)
+
+def loadEvaluationCube(db, labNumber, cacheDir=None, useCache=True):
+	# The lab's EvaluationCube, from the on-disk cache if the lab's evaluations haven't changed since it was written (memory-mapped, so every caller shares the same pages), and otherwise rebuilt from the database and cached again.
+	fingerprint = db.getLabFingerprint(labNumber)
+	if not useCache:
+		return buildEvaluationCube(db, labNumber, fingerprint)
+	if cacheDir is None:
+		cacheDir = getCubeCacheDir(db)
+	path = os.path.join(cacheDir, 'lab'+str(labNumber)+'_'+fingerprint)
+	if not os.path.isdir(path):
+		cube = buildEvaluationCube(db, labNumber, fingerprint)
+		# drop this lab's stale cubes
+		for oldPath in glob.glob(os.path.join(cacheDir, 'lab'+str(labNumber)+'_*')):
+			shutil.rmtree(oldPath, ignore_errors=True)
+		if not os.path.isdir(cacheDir):
+			os.makedirs(cacheDir)
+		cube.save(path)
+	return loadCubeFile(path)
@@ -0,0 +1,244 @@
+# encoding: utf-8
+from __future__ import division
+from SWAPR3weights import *
+
+# Peer grades for every video in a lab at once. Each peer rating of a submitted video is turned into a score with the lab's ratingKeys, and each (video, item)'s scores are combined by one of the statistics below, as NumPy reductions over all the lab's ratings together; no per-video queries or loops.
+#
+# A submitter's ratings of their own video don't count. The item score is clipped to the item's range of scores, the video's score is the sum of its item scores (items nobody rated count 0), and grades are percentages of the maximum. Grades go to itemGrades and finalGrades for the video's submitter(s), replacing that algorithm's earlier grades for the lab.
+#
+# These definitions are this module's own; they haven't been checked against SWAPR3grades.assignGrades (which isn't in this tree). So defaultGradeSpecs have names of their own, and never replace the grades assignGrades writes under its algorithm names (BIBI_1, median, mean, offMean_1).
+
+class GradeSpec:
+	'''How to combine a video's peer scores into a grade:
+		statistic: 'mean' or 'median'
+		weightType: weight each reviewer's score by their weight of this type for the item (a weighted mean); None for an unweighted statistic
+		offsetType: first subtract the reviewer's weight of this type for the item (e.g. 'weightOffset') from their score
+		nCalibration: which weights to use
+		fallback: the unweighted statistic to use where a video's reviewers have no weight at all for an item'''
+	def __init__(self, name, statistic='mean', weightType=None, offsetType=None, nCalibration=3, fallback='median', longName=None):
+		if statistic not in ['mean', 'median'] or fallback not in ['mean', 'median']:
+			raise ValueError('statistic and fallback must each be mean or median')
+		if weightType is not None and statistic != 'mean':
+			raise ValueError('Only the mean can be weighted')
+		self.name = name
+		self.statistic = statistic
+		self.weightType = weightType
+		self.offsetType = offsetType
+		self.nCalibration = nCalibration
+		self.fallback = fallback
+		self.longName = longName if longName is not None else name
+
+	def identity(self):
+		# A string that changes whenever what this spec computes does, for SWAPRdb.getStageFingerprint
+		return 'GradeSpec('+','.join([repr(value) for value in [self.statistic, self.weightType, self.offsetType, self.nCalibration, self.fallback]])+')'
+
+	def inputTables(self):
+		# The tables this spec's grades are computed from
+		return ['studentEvaluations', 'submissions', 'rubrics', 'ratingKeys']+(['weights'] if self.weightType is not None or self.offsetType is not None else [])
+
+# Counterparts of the algorithms SWAPR3run.py grades with
+defaultGradeSpecs = [
+	GradeSpec('engineBIBI_1', 'mean', weightType='weightBIBI', fallback='median', longName=u"Binary Item-by-Item ±1 (grade engine)"),
+	GradeSpec('engineMedian', 'median', longName='Median (grade engine)'),
+	GradeSpec('engineMean', 'mean', longName='Mean (grade engine)'),
+	GradeSpec('engineOffMean_1', 'mean', weightType='weightBIBI', offsetType='weightOffset', fallback='mean', longName=u"Offset Mean ±1 (grade engine)"),
+	]
+
+class PeerRatings:
+	'''Every scored peer rating of a submitted video in a lab, other than its submitters' own, as flat arrays (one entry per rating):
+		video: index into URLs
+		item: index into itemIndices
+		reviewer: index into wIDs
+		score: the rating's score from ratingKeys
+	with each video's submitters in owners, and each item's score range in itemMin and itemMax'''
+	def __init__(self, db, labNumber, cube=None):
+		if cube is None:
+			cube = loadEvaluationCube(db, labNumber)
+		scoresDict = db.getScoresDict(labNumber)
+		self.labNumber = labNumber
+		self.wIDs = cube.wIDs
+		self.itemIndices = cube.itemIndices
+		self.itemMin = np.array([min(scoresDict[itemIndex].values()) if scoresDict.get(itemIndex) else np.nan for itemIndex in self.itemIndices])
+		self.itemMax = np.array([max(scoresDict[itemIndex].values()) if scoresDict.get(itemIndex) else np.nan for itemIndex in self.itemIndices])
+
+		# Only submitted videos get grades (not the expert ones)
+		db.cursor.execute("SELECT DISTINCT URL, wID FROM submissions WHERE labNumber = ? AND URL IS NOT NULL ORDER BY wID",[labNumber])
+		self.owners = {}
+		for URL, wID in db.cursor.fetchall():
+			self.owners.setdefault(URL, []).append(wID)
+		submitted = np.array([URL in self.owners for URL in cube.URLs] + [False], dtype=bool)
+
+		# and a submitter's ratings of their own video don't count
+		wIDindex = dict((wID, r) for r, wID in enumerate(cube.wIDs))
+		ownVideo = np.zeros((len(cube.wIDs), len(cube.URLs) + 1), dtype=bool)
+		for v, URL in enumerate(cube.URLs):
+			for wID in self.owners.get(URL, []):
+				if wID in wIDindex:
+					ownVideo[wIDindex[wID], v] = True
+
+		scores = lookupScores(np.asarray(cube.ratings), self.itemIndices, scoresDict)
+		videos = np.where(np.asarray(cube.slotURL) >= 0, cube.slotURL, len(cube.URLs))[:, :, np.newaxis]
+		keep = ~np.isnan(scores) & submitted[videos] & ~ownVideo[np.arange(len(cube.wIDs))[:, np.newaxis, np.newaxis], videos]
+		reviewer, slot, item = np.nonzero(keep)
+		self.URLs = cube.URLs
+		self.video = np.asarray(cube.slotURL)[reviewer, slot]
+		self.item = item
+		self.reviewer = reviewer
+		self.score = scores[reviewer, slot, item]
+
+	def reviewerValues(self, db, weightType, nCalibration):
+		# Each rating's reviewer's weight of weightType for the rating's item (0 if they have none; the latest, if an older version of this code left several)
+		values = np.zeros((len(self.wIDs), len(self.itemIndices)))
+		wIDindex = dict((wID, r) for r, wID in enumerate(self.wIDs))
+		itemIndexMap = dict((itemIndex, i) for i, itemIndex in enumerate(self.itemIndices))
+		db.cursor.execute("SELECT wID, itemIndex, weight FROM weights WHERE labNumber = ? AND weightType = ? AND nCalibration = ? ORDER BY row",[self.labNumber, weightType, nCalibration])
+		for wID, itemIndex, weight in db.cursor:
+			if wID in wIDindex and itemIndex in itemIndexMap and weight is not None:
+				values[wIDindex[wID], itemIndexMap[itemIndex]] = float(weight)
+		return values[self.reviewer, self.item]
+
+def groupMeans(groups, values, nGroups, weights=None):
+	# The (weighted) mean of values in each group; NaN for groups with no values, or no weight
+	if weights is None:
+		weights = np.ones(len(values))
+	total = np.bincount(groups, weights=weights*values, minlength=nGroups)
+	totalWeight = np.bincount(groups, weights=weights, minlength=nGroups)
+	means = np.full(nGroups, np.nan)
+	np.divide(total, totalWeight, out=means, where=totalWeight != 0)
+	return means
+
+def groupMedians(groups, values, nGroups):
+	# The median of values in each group; NaN for groups with no values
+	order = np.lexsort((values, groups))
+	values = values[order]
+	counts = np.bincount(groups, minlength=nGroups)
+	starts = np.cumsum(counts) - counts
+	medians = np.full(nGroups, np.nan)
+	rated = counts > 0
+	low = starts[rated] + (counts[rated] - 1)//2
+	high = starts[rated] + counts[rated]//2
+	medians[rated] = (values[low] + values[high])/2
+	return medians
+
+def computeItemScores(ratings, spec, weights=None, offsets=None):
+	# (videos x items) item scores for spec; NaN where nobody rated the item. weights and offsets are from ratings.reviewerValues for spec's weightType and offsetType.
+	nItems = len(ratings.itemIndices)
+	nGroups = len(ratings.URLs)*nItems
+	groups = ratings.video*nItems + ratings.item
+	scores = ratings.score
+	if offsets is not None:
+		scores = scores - offsets
+	unweighted = groupMedians if spec.statistic == 'median' else groupMeans
+	if weights is None:
+		itemScores = unweighted(groups, scores, nGroups)
+	else:
+		itemScores = groupMeans(groups, scores, nGroups, weights)
+		fallback = groupMedians(groups, scores, nGroups) if spec.fallback == 'median' else groupMeans(groups, scores, nGroups)
+		itemScores = np.where(np.isnan(itemScores), fallback, itemScores)
+	itemScores = itemScores.reshape(len(ratings.URLs), nItems)
+	with np.errstate(invalid='ignore'):
+		return np.clip(itemScores, ratings.itemMin, ratings.itemMax)
+
+def gradeRows(ratings, spec, itemScores, term, runId):
+	# (itemGrades rows, finalGrades rows) for every rated, submitted video
+	maxScore = np.nansum(ratings.itemMax)
+	itemRows = []
+	finalRows = []
+	for v in np.nonzero(~np.isnan(itemScores).all(axis=1))[0]:
+		URL = ratings.URLs[v]
+		score = float(np.nansum(itemScores[v]))
+		for wID in ratings.owners[URL]:
+			for i, itemIndex in enumerate(ratings.itemIndices):
+				if not np.isnan(itemScores[v, i]):
+					itemRows.append([term, ratings.labNumber, wID, URL, itemIndex, float(itemScores[v, i]), 100*float(itemScores[v, i])/float(ratings.itemMax[i]), spec.name, runId])
+			finalRows.append([term, ratings.labNumber, wID, URL, score, 100*score/float(maxScore), spec.name, runId])
+	return itemRows, finalRows
+
+itemGradesColumns = ['term', 'labNumber', 'wID', 'URL', 'itemIndex', 'itemScore', 'itemGrade', 'algorithm', 'runId']
+finalGradesColumns = ['term', 'labNumber', 'wID', 'URL', 'score', 'grade', 'algorithm', 'runId']
+
+def getGradeSpec(algorithm):
+	# algorithm is a GradeSpec, or the name of one in defaultGradeSpecs
+	if isinstance(algorithm, GradeSpec):
+		return algorithm
+	for spec in defaultGradeSpecs:
+		if spec.name == algorithm:
+			return spec
+	raise ValueError('Unknown grading algorithm '+str(algorithm))
+
+def assignGradesMany(db, labNumber, algorithms, term='F2014', skipUnchanged=True):
+	# Grade every submitted video in the lab with each of algorithms (GradeSpecs, or names of defaultGradeSpecs), replacing their earlier grades for the lab. The ratings, scores and each weight type are loaded once for all of them, and every grade is written in one run and one transaction.
+	# Algorithms whose inputs (the lab's evaluations, submissions, rubric, rating keys and weights, and the spec itself) haven't changed since they last graded the lab are skipped, unless skipUnchanged is False.
+	specs = []
+	fingerprints = {}
+	labFingerprints = {}	# specs with the same input tables share one scan of them
+	for spec in [getGradeSpec(algorithm) for algorithm in algorithms]:
+		tableNames = tuple(spec.inputTables())
+		if tableNames not in labFingerprints:
+			labFingerprints[tableNames] = db.getLabFingerprint(labNumber, tableNames)
+		fingerprints[spec.name] = db.getStageFingerprint(labFingerprints[tableNames], spec.identity())
+		if skipUnchanged and db.getCachedStage('grades '+spec.name, labNumber, fingerprints[spec.name], 'finalGrades', "algorithm = ?", [spec.name]) is not None:
+			print('Grades '+spec.name+' are up to date for lab '+str(labNumber))
+		else:
+			specs.append(spec)
+	if specs == []:
+		return
+	ratings = PeerRatings(db, labNumber)
+	reviewerValues = {}
+	def getValues(weightType, nCalibration):
+		if weightType is None:
+			return None
+		if (weightType, nCalibration) not in reviewerValues:
+			reviewerValues[(weightType, nCalibration)] = ratings.reviewerValues(db, weightType, nCalibration)
+		return reviewerValues[(weightType, nCalibration)]
+	itemScores = [computeItemScores(ratings, spec, getValues(spec.weightType, spec.nCalibration), getValues(spec.offsetType, spec.nCalibration)) for spec in specs]
+
+	runId = db.beginRun('assignGradesMany '+','.join([spec.name for spec in specs]), labNumber, term)
+	nRows = 0
+	for spec, specItemScores in zip(specs, itemScores):
+		itemRows, finalRows = gradeRows(ratings, spec, specItemScores, term, runId)
+		for tableName in ['itemGrades', 'finalGrades']:
+			db.cursor.execute("DELETE FROM "+db.storageTable(tableName)+" WHERE labNumber = ? AND algorithm = ?",[labNumber, spec.name])
+		nRows += db.insertRows('itemGrades', itemGradesColumns, itemRows)
+		nRows += db.insertRows('finalGrades', finalGradesColumns, finalRows)
+		db.recordStage('grades '+spec.name, labNumber, fingerprints[spec.name], runId)
+		print('Graded '+str(len(finalRows))+' submissions for lab '+str(labNumber)+' with '+spec.name)
+	db.endRun(runId, nRows)
+	db.conn.commit()
+
+def assignPeerGrades(db, labNumber, spec, term='F2014'):
+	# Grade every submitted video in the lab with spec (a GradeSpec, or the name of one of defaultGradeSpecs), replacing its earlier grades for the lab
+	assignGradesMany(db, labNumber, [spec], term)
+
+# assignAllCalibrationGrades' rows go in calibrationGrades under this prefix and the weightType, e.g. 'engine:weightBIBI', since its formula is this module's own (like defaultGradeSpecs, see above) and mustn't replace what SWAPR3grades.assignCalibrationGrades wrote
+engineWeightTypePrefix = 'engine:'
+
+def assignAllCalibrationGrades(db, labNumber, term='F2014', skipUnchanged=True):
+	# Calibration grades for every (weightType, nCalibration) the lab has weights for, from one grouped pass over its weights: calibrationScore is the sum of the reviewer's item weights (the latest, if an older version of this code left several) and calibrationGrade that as a percentage of the number of items. They're written under weightType engineWeightTypePrefix+weightType, replacing the lab's earlier ones. Weight types that aren't a credit, like weightOffset, are skipped.
+	# Nothing is done if the lab's weights haven't changed since the last time, unless skipUnchanged is False.
+	notCredit = sorted([name for name, scheme in weightSchemes.items() if scheme.kernel is not None])
+	fingerprint = db.getStageFingerprint(db.getLabFingerprint(labNumber, ['weights']), 'calibrationGrades '+repr(notCredit))
+	if skipUnchanged and db.getCachedStage('calibrationGrades', labNumber, fingerprint, 'calibrationGrades') is not None:
+		print('Calibration grades are up to date for lab '+str(labNumber))
+		return
+	db.cursor.execute('''SELECT w.weightType, w.nCalibration, w.wID, total(w.weight), count(*)
+		FROM weights w
+		WHERE
+			w.labNumber = ?
+			AND w.row IN (SELECT max(row) FROM weights WHERE labNumber = ? GROUP BY weightType, nCalibration, wID, itemIndex)
+		GROUP BY w.weightType, w.nCalibration, w.wID
+		ORDER BY w.weightType, w.nCalibration, w.wID''',[labNumber, labNumber])
+	data = [entry for entry in db.cursor.fetchall() if entry[0] not in notCredit]
+
+	runId = db.beginRun('assignAllCalibrationGrades', labNumber, term)
+	nRows = 0
+	for (weightType, nCalibration), group in groupby(data, lambda entry: (entry[0], entry[1])):
+		db.cursor.execute("DELETE FROM "+db.storageTable('calibrationGrades')+" WHERE labNumber = ? AND weightType = ? AND nCalibration = ?",[labNumber, engineWeightTypePrefix+weightType, nCalibration])
+		afterRow = db.getMaxRow('calibrationGrades')
+		nRows += db.executeBatches("INSERT INTO calibrationGrades(row, time, term, labNumber, wID, nCalibration, calibrationScore, calibrationGrade, weightType) VALUES (NULL,NULL,?,?,?,?,?,?,?)",
+			([term, labNumber, wID, nCalibration, float(score), 100*float(score)/nItems, engineWeightTypePrefix+weightType] for weightType, nCalibration, wID, score, nItems in group))
+		db.stampRun('calibrationGrades', runId, afterRow)
+	db.recordStage('calibrationGrades', labNumber, fingerprint, runId)
+	db.endRun(runId, nRows)
+	db.conn.commit()
+	print('Wrote '+str(nRows)+' calibration grades for lab '+str(labNumber))
@@ -4,77 +4,92 @@ from SWAPR3 import *
 from SWAPR3grades import *
 import os
 
-# ED: Download the student responses to the submission assignment from Webassign and put them
-# makeDatabase('SOUP2017.sqlite')
-db=SWAPRdb('/Users/Scott/Research/SOUP 2017 SWAPR/SOUP2017.sqlite')
-# db.createTables()
-# db.cursor.execute('''ATTACH DATABASE "/Users/Scott/SWAPR/S2014Campus_legacy.sqlite" AS old''')
-# db.cursor.execute('''SELECT DISTINCT labNumber, questionIndex, wQuestion FROM old.questions''')
-# data = [[entry[0], entry[1], entry[2]] for entry in db.cursor.fetchall()]
-# for entry in data:
-#     db.cursor.execute('''UPDATE assignments SET wQuestion = ? WHERE labNumber = ? AND questionIndex = ?''', [entry[2], entry[0], entry[1]])
+# The pipeline only runs when this file is run as a script, not when it's imported (as multiprocessing does in each ingestEvaluationsDir worker when workers > 1)
+if __name__ == '__main__':
+    # ED: Download the student responses to the submission assignment from Webassign and put them
+    # makeDatabase('SOUP2017.sqlite')
+    # 'wal' switches the database to WAL journaling the first time (and is a no-op after that), so SWAPRgradeDist.py can read while this runs
+    db=SWAPRdb('/Users/Scott/Research/SOUP 2017 SWAPR/SOUP2017.sqlite', profile='wal')
+    # db.createTables()
+    # db.cursor.execute('''ATTACH DATABASE "/Users/Scott/SWAPR/S2014Campus_legacy.sqlite" AS old''')
+    # db.cursor.execute('''SELECT DISTINCT labNumber, questionIndex, wQuestion FROM old.questions''')
+    # data = [[entry[0], entry[1], entry[2]] for entry in db.cursor.fetchall()]
+    # for entry in data:
+    #     db.cursor.execute('''UPDATE assignments SET wQuestion = ? WHERE labNumber = ? AND questionIndex = ?''', [entry[2], entry[0], entry[1]])
 
-# db.cursor.execute('''DELETE FROM studentEvaluations''')
-# db.cursor.execute('''DELETE FROM submissions''')
-for labNumber in [4]:
-    # Define Algorithms
-    calibAlgs = [
-        calibAlg("BIBI_1",
-            weightedSumMedianFallback,
-            weightBIBI,
-            longName = u"Binary Item-by-Item ±1"), # Used for grades in F2013
-        calibAlg("median",
-            sumMedian,
-            longName = "Median"),
-        calibAlg("mean",
-            sumMean,
-            longName = "Mean"),
-        calibAlg("offMean_1",
-            weightedSumOffset,
-            weightBIBI,
-            longName = u"Offset Mean ±1", offsetStyle = "weightOffset")
-        ]
+    # db.cursor.execute('''DELETE FROM studentEvaluations''')
+    # db.cursor.execute('''DELETE FROM submissions''')
+    for labNumber in [4]:
+        # Define Algorithms
+        calibAlgs = [
+            calibAlg("BIBI_1",
+                weightedSumMedianFallback,
+                weightBIBI,
+                longName = u"Binary Item-by-Item ±1"), # Used for grades in F2013
+            calibAlg("median",
+                sumMedian,
+                longName = "Median"),
+            calibAlg("mean",
+                sumMean,
+                longName = "Mean"),
+            calibAlg("offMean_1",
+                weightedSumOffset,
+                weightBIBI,
+                longName = u"Offset Mean ±1", offsetStyle = "weightOffset")
+            ]
 
-    # db.cursor.execute('''DROP TABLE IF EXISTS rubrics''')
-    # db.cursor.execute('''DROP TABLE IF EXISTS studentEvaluations''')
-    # db.cursor.execute('''DROP TABLE IF EXISTS weights''')
-    # db.cursor.execute('''DROP TABLE IF EXISTS finalGrades''')
-    # db.cursor.execute('''DROP TABLE IF EXISTS itemGrades''')
-    # db.cursor.execute('''DROP TABLE IF EXISTS calibrationGrades''')
-    # db.cursor.execute('''DELETE FROM submissions WHERE labNumber=?''',[labNumber])
-    # db.cursor.execute('''DELETE FROM expertEvaluations WHERE labNumber=?''',[labNumber])
-    # db.cursor.execute('''DELETE FROM assignments WHERE labNumber=?''',[labNumber])
-    # db.cursor.execute('''DELETE FROM weights WHERE labNumber=?''',[labNumber])
-    # db.cursor.execute('''DELETE FROM finalGrades WHERE labNumber=?''',[labNumber])
-    # db.cursor.execute('''DELETE FROM itemGrades WHERE labNumber=?''',[labNumber])
-    # db.cursor.execute('''DELETE FROM calibrationGrades WHERE labNumber=?''',[labNumber])
-    # db.cursor.execute('''DELETE FROM studentEvaluations WHERE labNumber=?''',[labNumber])
-    # db.cursor.execute('''DELETE FROM rubrics WHERE labNumber=?''',[labNumber])
-    # db.cursor.execute('''DELETE FROM ratingKeys WHERE labNumber=?''',[labNumber])
-    # db.createTables()
-    # db.parseExpertEvaluations('F2014Lab'+str(labNumber)+'Experts.txt')
-    # for file in listdir_nohidden('/Users/Scott/Research/SOUP 2017 SWAPR/Lab {}/Submissions/'.format(labNumber) ):
-    #     print("Parsing "+str(file)+'...')
-    #     db.parseSubmissions(file,labNumber,linkCol=4 if labNumber != 3 else 5,term='SOUP2017', verbose=True)
-    # db.assignURLs(labNumber, term='SOUP2017')
-    # db.exportWebassign('Lab{}Output.txt'.format(labNumber),labNumber)
+        # db.cursor.execute('''DROP TABLE IF EXISTS rubrics''')
+        # db.cursor.execute('''DROP TABLE IF EXISTS studentEvaluations''')
+        # db.cursor.execute('''DROP TABLE IF EXISTS weights''')
+        # db.cursor.execute('''DROP TABLE IF EXISTS finalGrades''')
+        # db.cursor.execute('''DROP TABLE IF EXISTS itemGrades''')
+        # db.cursor.execute('''DROP TABLE IF EXISTS calibrationGrades''')
+        # db.cursor.execute('''DELETE FROM submissions WHERE labNumber=?''',[labNumber])
+        # db.cursor.execute('''DELETE FROM expertEvaluations WHERE labNumber=?''',[labNumber])
+        # db.cursor.execute('''DELETE FROM assignments WHERE labNumber=?''',[labNumber])
+        # db.cursor.execute('''DELETE FROM weights WHERE labNumber=?''',[labNumber])
+        # db.cursor.execute('''DELETE FROM finalGrades WHERE labNumber=?''',[labNumber])
+        # db.cursor.execute('''DELETE FROM itemGrades WHERE labNumber=?''',[labNumber])
+        # db.cursor.execute('''DELETE FROM calibrationGrades WHERE labNumber=?''',[labNumber])
+        # db.cursor.execute('''DELETE FROM studentEvaluations WHERE labNumber=?''',[labNumber])
+        # db.cursor.execute('''DELETE FROM rubrics WHERE labNumber=?''',[labNumber])
+        # db.cursor.execute('''DELETE FROM ratingKeys WHERE labNumber=?''',[labNumber])
+        # db.clearManifest(labNumber=labNumber) # so the deleted files get ingested again
+        # Or, to undo just one bad ingest/weight/grade run: look it up in db.listRuns(labNumber) and
+        # db.rollbackRun(runId)
+        # db.createTables()
+        # db.parseExpertEvaluations('F2014Lab'+str(labNumber)+'Experts.txt')
+        # for file in listdir_nohidden('/Users/Scott/Research/SOUP 2017 SWAPR/Lab {}/Submissions/'.format(labNumber) ):
+        #     print("Parsing "+str(file)+'...')
+        #     db.parseSubmissions(file,labNumber,linkCol=4 if labNumber != 3 else 5,term='SOUP2017', verbose=True)
+        # db.assignURLs(labNumber, term='SOUP2017')
+        # or, to keep students from reviewing their own section or each other, and give each one only one of the hidden calibration videos:
+        # db.assignURLs(labNumber, term='SOUP2017', solver=True, hiddenPerStudent=1)
+        # and later, for students who submit after that, without changing anyone else's assignments:
+        # db.assignLateSubmissions(labNumber, term='SOUP2017')
+        # db.exportWebassign('Lab{}Output.txt'.format(labNumber),labNumber)
 
-    # db.addDefaultRubric(labNumber=labNumber,term="SOUP2016")
-    # Gather evaluations and assign weights & grades
-    for file in listdir_nohidden('/Users/Scott/Research/SOUP 2017 SWAPR/Lab {}/Responses/'.format(labNumber)):
-        print("Parsing "+str(file)+'...')
-        db.parseEvaluationsFile(file,labNumber,term='SOUP2017')
+        # db.addDefaultRubric(labNumber=labNumber,term="SOUP2016")
+        # Gather evaluations and assign weights & grades
+        db.ingestEvaluationsDir('/Users/Scott/Research/SOUP 2017 SWAPR/Lab {}/Responses/'.format(labNumber),labNumber,term='SOUP2017') # add workers=None to parse the files on every CPU
         
-    # We need weightBIBI, weightDIBI_full, weightDIBI_full_curved, and weightOffset
-    # assignWeights(db,labNumber=labNumber,f=weightDIBI_full)
-    # assignWeights(db,labNumber=labNumber,f=weightDIBI_full_curved)
-    # assignGrades(db,labNumber=labNumber,algorithm=calibAlgs[1])
-    # assignGrades(db,labNumber=labNumber,algorithm=calibAlgs[2])
+        # We need weightBIBI, weightDIBI_full, weightDIBI_full_curved, and weightOffset
+        # assignWeights(db,labNumber=labNumber,f=weightDIBI_full)
+        # assignWeights(db,labNumber=labNumber,f=weightDIBI_full_curved)
+        # assignGrades(db,labNumber=labNumber,algorithm=calibAlgs[1])
+        # assignGrades(db,labNumber=labNumber,algorithm=calibAlgs[2])
 
-    assignWeights(db,labNumber=labNumber,f=weightBIBI)
-    assignWeights(db,labNumber=labNumber,f=weightOffset)
-    assignGrades(db,labNumber=labNumber,algorithm=calibAlgs[3])
-    assignCalibrationGrades(db,labNumber=labNumber)
-    printCalibrationGradesReport(db,'Lab'+str(labNumber)+'CalibrationGrades.txt',labNumber=labNumber,weightType='weightBIBI')
-    printFinalGradesReport(db,'Lab'+str(labNumber)+'Grades.txt',labNumber=labNumber,algorithm='offMean_1')
-    db.writeCommentsTabDelimited('Lab'+str(labNumber)+'Comments.txt',labNumber=labNumber)
\ No newline at end of file
+        updateWeights(db,labNumber=labNumber,f=[weightBIBI,weightOffset]) # only recomputes reviewers with new evaluations (assignWeights would recompute everyone whenever anything changed); both replace the weights the other wrote
+        assignGrades(db,labNumber=labNumber,algorithm=calibAlgs[3])
+        # Or, to compare the grade engine's versions of all four algorithms from one load of the lab (from SWAPR3gradeEngine import *); they're written under their own names, e.g. algorithm='engineOffMean_1' for printFinalGradesReport:
+        # assignGradesMany(db,labNumber,['engineBIBI_1','engineMedian','engineMean','engineOffMean_1'],term='SOUP2017')
+        # and its calibration grades for every weight type at once, under e.g. weightType='engine:weightBIBI':
+        # assignAllCalibrationGrades(db,labNumber,term='SOUP2017')
+        # If you use them instead, assignWeights, assignGradesMany and assignAllCalibrationGrades skip whatever is already up to date for the lab's inputs (updateWeights keeps track with its own change watermarks); see what they've cached with
+        # db.listStageCache(labNumber)
+        # and make them run again anyway with
+        # db.invalidateStages(labNumber=labNumber)
+        assignCalibrationGrades(db,labNumber=labNumber)
+        printCalibrationGradesReport(db,'Lab'+str(labNumber)+'CalibrationGrades.txt',labNumber=labNumber,weightType='weightBIBI')
+        printFinalGradesReport(db,'Lab'+str(labNumber)+'Grades.txt',labNumber=labNumber,algorithm='offMean_1')
+        db.writeCommentsTabDelimited('Lab'+str(labNumber)+'Comments.txt',labNumber=labNumber)
\ No newline at end of file
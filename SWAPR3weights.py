@@ -1,6 +1,8 @@
 from __future__ import division
 from SWAPR3 import *
+from SWAPR3cube import *
 from itertools import groupby
+import array
 
 # The "pairs" list contains one entry for each student. Each entry looks like
 # [ 'wID' , [ [ [studentResponse0],[expertResponse0] ], [ [studentResponse1],[expertResponse1] ]...  ], [itemIndices] ]
@@ -311,106 +313,468 @@ def perform(f, *args):
 	# Allow us to pass in another function as an argument, for easily switching out the weighting algorithms
 	f(*args)
 
-def getExpertResponsePairs(data):
-	responsePairsBywID = []
-	# group by wID
-	for wID, tempwIDgroup in groupby(data,lambda entry: str(entry[0])):
+class ResponsePairs(object):
+	'''The response pairs for the weight functions, in flat arrays rather than nested lists:
+		student, expert: one rating per (reviewer, video, item) row; NaN for a blank student rating or an unusable expert one
+		itemIndices: the row's itemIndex
+		pairStarts: where each (reviewer, video) pair's rows start, followed by the end
+		reviewerStarts: where each reviewer's pairs start in pairStarts, followed by the end
+		wIDs: one per reviewer
+	pairs[i] (and iterating) gives the [ wID, [ [studentResponses, expertResponses], ...], itemIndices ] lists described at the top of this file, so the weight functions work unchanged.'''
+	__slots__ = ['wIDs', 'student', 'expert', 'itemIndices', 'pairStarts', 'reviewerStarts', 'cached']
+
+	def __init__(self, wIDs, student, expert, itemIndices, pairStarts, reviewerStarts):
+		self.wIDs = wIDs
+		self.student = student
+		self.expert = expert
+		self.itemIndices = itemIndices
+		self.pairStarts = pairStarts
+		self.reviewerStarts = reviewerStarts
+		self.cached = (None, None)
+
+	def __len__(self):
+		return len(self.wIDs)
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += len(self)
+		if not 0 <= i < len(self):
+			raise IndexError('ResponsePairs index out of range')
+		# The weight functions ask for the same student several times in a row
+		if self.cached[0] == i:
+			return self.cached[1]
 		responsePairs = []
-		wID = str(wID)
-		# group by URL
-		wIDgroup = list(tempwIDgroup)
-		for URL, wIDlist in groupby(wIDgroup, lambda entry: str(entry[1])):
-			sortedList = list(wIDlist)
-			# print(sortedList)
-			studentstudentEvaluations = []
-			expertstudentEvaluations = []
-			itemIndices = []
-
-			for entry in sortedList:
-				try:
-					studentstudentEvaluations.append(float(entry[2]))
-				except:
-					studentstudentEvaluations.append(None)
-
-				try:
-					expertstudentEvaluations.append(float(entry[3]))
-				except:
-					print('Invalid expert response! URL='+str(URL))
-				try:
-					itemIndices.append(int(entry[4]))
-				except:
-					print("Invalid item index: "+str(entry))
-					break
-			responsePairs.append([studentstudentEvaluations,expertstudentEvaluations])
-
-		responsePairsBywID.append([wID,responsePairs,itemIndices])
-	# print(responsePairsBywID[0])
-
-	return responsePairsBywID
-
-
-def assignWeights(db,labNumber,f,nCalibration=3,term='F2014'):
-	if nCalibration == 3:
-		db.cursor.execute('''SELECT e.wID, e.URL, e.rating, expertEvaluations.rating, e.itemIndex 
-			FROM studentEvaluations e, expertEvaluations, rubrics 
-			WHERE 
-				--match itemIndex
-				e.itemIndex = expertEvaluations.itemIndex 
-				AND e.itemIndex = rubrics.itemIndex 
-				--match labNumber
-				AND e.labNumber = ? 
-				AND rubrics.labNumber = e.labNumber 
-				AND expertEvaluations.labNumber = e.labNumber
+		itemIndices = []
+		for p in range(self.reviewerStarts[i], self.reviewerStarts[i+1]):
+			start, end = self.pairStarts[p], self.pairStarts[p+1]
+			studentResponses = [None if np.isnan(rating) else rating for rating in self.student[start:end].tolist()]
+			# Unusable expert ratings are left out, so that the pair doesn't count
+			expertResponses = [rating for rating in self.expert[start:end].tolist() if not np.isnan(rating)]
+			responsePairs.append([studentResponses, expertResponses])
+			itemIndices = self.itemIndices[start:end].tolist()
+		entry = [self.wIDs[i], responsePairs, itemIndices]
+		self.cached = (i, entry)
+		return entry
 
-				AND rubrics.graded 
-				and expertEvaluations.URL = e.URL 
-				AND expertEvaluations.labNumber = e.labNumber 
-				AND NOT expertEvaluations.videoLabel LIKE 'Practice%' 
-				ORDER BY e.wID, e.URL, e.itemIndex''',[labNumber])
-	elif nCalibration == 2:
-		db.cursor.execute('''SELECT r.wID, r.URL, r.rating, expertEvaluations.rating, r.itemIndex 
-			FROM studentEvaluations r, expertEvaluations, rubrics 
-			WHERE 
-				--match itemIndex
-				r.itemIndex = expertEvaluations.itemIndex 
-				AND r.itemIndex = rubrics.itemIndex 
-				--match labNumber
-				AND r.labNumber = ? 
-				AND rubrics.labNumber = r.labNumber 
-				AND expertEvaluations.labNumber = r.labNumber
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
 
-				AND rubrics.graded 
-				and expertEvaluations.URL = r.URL 
-				AND expertEvaluations.labNumber = r.labNumber 
-				AND NOT expertEvaluations.videoLabel LIKE 'Practice%' 
-				AND NOT expertEvaluations.videoLabel LIKE 'Hidden%'
-				ORDER BY r.wID, r.URL, r.itemIndex''',[labNumber])
-	elif nCalibration == 1:
-		db.cursor.execute('''SELECT r.wID, r.URL, r.rating, expertEvaluations.rating, r.itemIndex 
-			FROM studentEvaluations r, expertEvaluations, rubrics 
-			WHERE 
-				--match itemIndex
-				r.itemIndex = expertEvaluations.itemIndex 
-				AND r.itemIndex = rubrics.itemIndex 
-				--match labNumber
-				AND r.labNumber = ? 
-				AND rubrics.labNumber = r.labNumber 
-				AND expertEvaluations.labNumber = r.labNumber
+def getExpertResponsePairs(data):
+	# data is (wID, URL, student rating, expert rating, itemIndex) rows, ordered by wID and URL
+	wIDs = []
+	student = array.array('d')
+	expert = array.array('d')
+	itemIndices = array.array('i')
+	pairStarts = array.array('i')
+	reviewerStarts = array.array('i')
+	lastwID = lastURL = None
+	for entry in data:
+		wID = str(entry[0])
+		URL = str(entry[1])
+		if wID != lastwID or wIDs == []:
+			wIDs.append(wID)
+			reviewerStarts.append(len(pairStarts))
+			lastwID = wID
+			lastURL = None
+		if URL != lastURL:
+			pairStarts.append(len(student))
+			lastURL = URL
+		try:
+			itemIndex = int(entry[4])
+		except:
+			# Leave out just this row, so the pair's other ratings stay with their own items
+			print("Invalid item index: "+str(entry))
+			continue
+		try:
+			expertRating = float(entry[3])
+		except:
+			print('Invalid expert response! URL='+str(URL))
+			expertRating = np.nan
+		student.append(toFloat(entry[2]))
+		expert.append(expertRating)
+		itemIndices.append(itemIndex)
+	pairStarts.append(len(student))
+	reviewerStarts.append(len(pairStarts) - 1)
+	return ResponsePairs(wIDs, np.frombuffer(student, dtype=np.float64), np.frombuffer(expert, dtype=np.float64), np.frombuffer(itemIndices, dtype=np.intc), np.frombuffer(pairStarts, dtype=np.intc), np.frombuffer(reviewerStarts, dtype=np.intc))
 
-				AND rubrics.graded 
-				and expertEvaluations.URL = r.URL 
-				AND expertEvaluations.labNumber = r.labNumber 
-				AND expertEvaluations.videoLabel LIKE 'Hidden%'
-				ORDER BY r.wID, r.URL, r.itemIndex''',[labNumber])
-	pairs = getExpertResponsePairs([entry for entry in db.cursor.fetchall()])
-	for entry in f(pairs,db.getScoresDict(labNumber)):
+
+# Vectorized versions of the weight functions above, for every reviewer at once. They work on the lab's EvaluationCube (see SWAPR3cube) and give exactly the same numbers as the loops: credit/E is added up one calibration video at a time, in URL order, just as the loops do it.
+
+calibrationKinds = {3: [SHOWN, HIDDEN], 2: [SHOWN], 1: [HIDDEN]}
+
+def between(values, low, high, inclusive):
+	if inclusive:
+		return (low <= values) & (values <= high)
+	return (low < values) & (values < high)
+
+class CalibrationData:
+	'''The calibration videos each reviewer rated, with their ratings lined up against the expert's'''
+	def __init__(self, cube, nCalibration=3):
+		# Calibration slots, as in the nCalibration queries in assignWeights
+		selected = np.isin(cube.slotKind(), calibrationKinds[nCalibration])
+		expert, expertPresent = cube.slotExpert()
+		joined = cube.present & expertPresent & selected[:, :, np.newaxis]
+		# E: the number of calibration videos the reviewer rated at all; reviewers without any get no weights
+		E = joined.any(axis=2).sum(axis=1)
+		reviewers = np.nonzero(E > 0)[0]
+		# Weighted items: the graded items the expert rated
+		items = np.nonzero((expertPresent & selected[:, :, np.newaxis]).any(axis=(0, 1)))[0]
+		self.wIDs = [cube.wIDs[r] for r in reviewers]
+		self.itemIndices = [cube.itemIndices[i] for i in items]
+		self.E = E[reviewers].astype(float)
+		self.student = cube.ratings[reviewers][:, :, items]
+		self.expert = expert[reviewers][:, :, items]
+		# Only pairs with every item there (student ratings may be blank, expert ratings may not) count towards the weights
+		self.valid = (selected[reviewers] & (cube.present[reviewers][:, :, items] & expertPresent[reviewers][:, :, items] & ~np.isnan(self.expert)).all(axis=2))
+		self.answered = self.valid[:, :, np.newaxis] & ~np.isnan(self.student)
+		with np.errstate(invalid='ignore'):
+			self.diff = np.abs(self.student - self.expert)
+		self.masks = {}
+
+	def accumulate(self, credit):
+		# Add up credit/E for each reviewer and item, one calibration video at a time, where the reviewer answered
+		weights = np.zeros((len(self.wIDs), len(self.itemIndices)))
+		for s in range(self.student.shape[1]):
+			weights += np.where(self.answered[:, s], credit[:, s]/self.E[:, np.newaxis], 0.0)
+		return weights
+
+	def within(self, bound, inclusive):
+		# diff <= bound (or < bound), kept so that every scheme with a step at this bound shares it
+		if (bound, inclusive) not in self.masks:
+			with np.errstate(invalid='ignore'):
+				self.masks[(bound, inclusive)] = (self.diff <= bound) if inclusive else (self.diff < bound)
+		return self.masks[(bound, inclusive)]
+
+	def steps(self, curve):
+		credit = np.zeros(self.diff.shape)
+		done = np.zeros(self.diff.shape, dtype=bool)
+		for bound, value, inclusive in curve:
+			hit = ~done & self.within(bound, inclusive)
+			credit[hit] = value
+			done |= hit
+		return credit
+
+	def inCategories(self, categories):
+		hit = np.zeros(self.diff.shape, dtype=bool)
+		with np.errstate(invalid='ignore'):
+			for category in categories:
+				low, high, inclusive = category[:3]
+				if len(category) > 3:
+					studentIn = self.within(category[3], False)
+				else:
+					studentIn = between(self.student, low, high, inclusive)
+				hit |= between(self.expert, low, high, inclusive) & studentIn
+		return hit
+
+	def responseCounts(self, scoresDict):
+		# The number of possible responses of each item, shaped to broadcast against the ratings
+		return np.array([len(scoresDict.get(itemIndex, {})) for itemIndex in self.itemIndices])[np.newaxis, np.newaxis, :]
+
+class WeightScheme:
+	'''A weight scheme described as data. The credit a calibration pair earns on an item comes from one of
+		curve: [(bound, credit, inclusive), ...]; the first step with |student - expert| < bound (<= if inclusive) gives the credit
+		categories: [(low, high, inclusive), ...]; credit 1 if the student and expert ratings fall in the same range. A category (low, high, inclusive, tolerance) only needs the expert rating in the range, and the student rating less than tolerance away from it.
+		responseCounts: {number of possible responses: WeightScheme}; a different rule depending on the item's number of responses, and no credit for items with any other number
+		kernel: a function(data, scoresDict) returning the weights array itself, for schemes like weightOffset that aren't about credit
+	The weight is the credit averaged over the reviewer's calibration videos.'''
+	def __init__(self, name=None, curve=None, categories=None, responseCounts=None, kernel=None, function=None):
+		self.name = name
+		self.curve = curve
+		self.categories = categories
+		self.responseCounts = responseCounts
+		self.kernel = kernel
+		self.function = function	# the weight function above that this scheme replaces, if any
+
+	def credit(self, data, scoresDict):
+		if self.curve is not None:
+			return data.steps(self.curve)
+		elif self.categories is not None:
+			return data.inCategories(self.categories)
+		credit = np.zeros(data.diff.shape)
+		counts = data.responseCounts(scoresDict)
+		for nResponses, scheme in self.responseCounts.items():
+			credit = np.where(counts == nResponses, scheme.credit(data, scoresDict), credit)
+		return credit
+
+	def weights(self, data, scoresDict):
+		if self.kernel is not None:
+			return self.kernel(data, scoresDict)
+		return data.accumulate(self.credit(data, scoresDict))
+
+	def identity(self):
+		# A string that changes whenever what this scheme computes does, for SWAPRdb.getStageFingerprint
+		parts = [repr(self.curve), repr(self.categories)]
+		if self.responseCounts is not None:
+			parts += [str(nResponses)+':'+self.responseCounts[nResponses].identity() for nResponses in sorted(self.responseCounts)]
+		if self.kernel is not None:
+			parts.append(functionIdentity(self.kernel))
+		return 'WeightScheme('+','.join(parts)+')'
+
+	def sqlCredit(self, diff):
+		# The credit as an SQL expression of diff, for assignWeightsInSQL
+		if self.curve is None:
+			raise ValueError('Weight scheme '+str(self.name)+' has no credit curve, so it cannot be computed in SQL')
+		if self.curve == []:
+			return '0.0'
+		return 'CASE '+' '.join(['WHEN '+diff+(' <= ' if inclusive else ' < ')+repr(float(bound))+' THEN '+repr(float(value)) for bound, value, inclusive in self.curve])+' ELSE 0.0 END'
+
+weightSchemes = {}
+
+def registerWeightScheme(scheme):
+	# Make scheme available to assignWeights and computeWeights by name; its weights are stored with weightType = scheme.name
+	weightSchemes[scheme.name] = scheme
+	return scheme
+
+def getWeightScheme(f):
+	# The WeightScheme for f (a WeightScheme, the name of a registered one, or a weight function above); None if f is some other weight function
+	if isinstance(f, WeightScheme):
+		return f
+	elif f in weightSchemes:
+		return weightSchemes[f]
+	scheme = weightSchemes.get(getattr(f, '__name__', None))
+	if scheme is not None and scheme.function is f:
+		return scheme
+	return None
+
+def lookupScores(values, itemIndices, scoresDict, key=lambda value: value):
+	# scoresDict[itemIndex][key(value)] for every rating in values (the last axis runs over itemIndices); NaN where there is no such score
+	scores = np.full(values.shape, np.nan)
+	for j, itemIndex in enumerate(itemIndices):
+		itemValues = values[..., j]
+		itemScores = scores[..., j]
+		for value in np.unique(itemValues[~np.isnan(itemValues)]):
+			try:
+				itemScores[itemValues == value] = scoresDict[itemIndex][key(float(value))]
+			except KeyError:
+				pass
+	return scores
+
+def offsetKernel(data, scoresDict):
+	studentScore = lookupScores(data.student, data.itemIndices, scoresDict)
+	expertScore = lookupScores(data.expert, data.itemIndices, scoresDict, key=round)
+	return data.accumulate(np.nan_to_num(studentScore - expertScore))
+
+exactMatch = WeightScheme(curve=[(0, 1, True)])
+
+registerWeightScheme(WeightScheme('weightOffset', kernel=offsetKernel, function=weightOffset))
+registerWeightScheme(WeightScheme('weightBIBI', curve=[(1.1, 1, True)], function=weightBIBI))
+registerWeightScheme(WeightScheme('weightDIBI_1', curve=[(0.5, 1, True)], function=weightDIBI_1))
+registerWeightScheme(WeightScheme('weightDIBI_05', curve=[(0.5, 1, True), (1.1, 0.5, True)], function=weightDIBI_05))
+registerWeightScheme(WeightScheme('weightDIBI_full', curve=[(1, 1, False), (2, 0.75, False), (3, 0.5, False), (4, 0.25, False)], function=weightDIBI_full))
+registerWeightScheme(WeightScheme('weightDIBI_full_curved', curve=[(1, 1, False), (2, 0.9, False), (3, 0.75, False), (4, 0.5, False)], function=weightDIBI_full_curved))
+registerWeightScheme(WeightScheme('weightCollapseTop2', responseCounts={
+	5: WeightScheme(categories=[(0, 2, False), (3, np.inf, False), (2, 3, False, 1)]),
+	3: exactMatch}, function=weightCollapseTop2))
+# As in weightCollapseMid3, the top category only earns credit through the middle-3 test (its == 4 test compares the whole response list)
+registerWeightScheme(WeightScheme('weightCollapseMid3', responseCounts={
+	5: WeightScheme(categories=[(1, 4, False), (-np.inf, 1, True)]),
+	3: exactMatch}, function=weightCollapseMid3))
+
+def computeWeights(cube, schemes, scoresDict, nCalibration=3):
+	# Weights for every scheme in schemes (WeightSchemes, their names or weight functions), from one pass over the cube. Returns the CalibrationData (for its wIDs and itemIndices) and {scheme name: weights array}.
+	data = CalibrationData(cube, nCalibration)
+	schemes = [getWeightScheme(scheme) for scheme in schemes]
+	return data, dict((scheme.name, scheme.weights(data, scoresDict)) for scheme in schemes)
+
+weightsColumns = ['term', 'labNumber', 'nCalibration', 'wID', 'itemIndex', 'weightType', 'weight', 'runId']
+
+def getCalibrationRows(db, labNumber):
+	# The rows for getExpertResponsePairs for every nCalibration at once: each student response to a (non-practice) expert video, tagged SHOWN or HIDDEN
+	# (Straight from studentEvaluationsFact, with inner joins to the keys, so SQLite can start from the expert videos and look up just their responses by URLkey, instead of going through the whole lab in the view)
+	db.cursor.execute('''SELECT studentKeys.wID, videoKeys.URL, e.rating, expertEvaluations.rating, e.itemIndex,
+			CASE WHEN expertEvaluations.videoLabel LIKE 'Hidden%' THEN ? ELSE ? END
+		FROM studentEvaluationsFact e, studentKeys, videoKeys, expertEvaluations, rubrics 
+		WHERE 
+			studentKeys.wIDkey = e.wIDkey
+			AND videoKeys.URLkey = e.URLkey
+			--match itemIndex
+			AND e.itemIndex = expertEvaluations.itemIndex 
+			AND e.itemIndex = rubrics.itemIndex 
+			--match labNumber
+			AND e.labNumber = ? 
+			AND rubrics.labNumber = e.labNumber 
+			AND expertEvaluations.labNumber = e.labNumber
+
+			AND rubrics.graded 
+			and expertEvaluations.URL = videoKeys.URL 
+			AND NOT expertEvaluations.videoLabel LIKE 'Practice%' 
+			ORDER BY studentKeys.wID, videoKeys.URL, e.itemIndex''',[HIDDEN, SHOWN, labNumber])
+	return db.cursor.fetchall()
+
+def pairWeightRows(pairs, weights, term, labNumber, nCalibration, weightType, runId):
+	# weights rows for what a weight function returned for pairs
+	itemIndices = pairs[0][2]
+	for entry in weights:
 		try:
 			wID = entry[0]
 			weight = entry[1]
-			itemIndices = pairs[0][2]
 			for i in range(len(weight)):
-				db.cursor.execute("INSERT INTO weights(row, time, term, labNumber, nCalibration, wID, itemIndex, weightType, weight) VALUES (NULL,?,?,?,?,?,?,?,?)",[datetime.now(),term,labNumber,nCalibration,wID,itemIndices[i],f.__name__,weight[i]])
+				yield [term, labNumber, nCalibration, wID, itemIndices[i], weightType, weight[i], runId]
 		except:
 			print('Could not calculate weight for '+wID)
+
+weightInputTables = ['studentEvaluations', 'expertEvaluations', 'rubrics', 'ratingKeys']
+
+def weightStage(db, labNumber, labFingerprint, name, identity, nCalibration, skipUnchanged):
+	# (stage, fingerprint, cached) for one weight function and nCalibration: cached is True if the lab's weights for them are already in the database and their inputs haven't changed since (and skipUnchanged). labFingerprint is db.getLabFingerprint(labNumber, weightInputTables).
+	stage = 'weights '+name+' '+str(nCalibration)
+	fingerprint = db.getStageFingerprint(labFingerprint, identity+' '+str(nCalibration))
+	cached = skipUnchanged and db.getCachedStage(stage, labNumber, fingerprint, 'weights', "weightType = ? AND nCalibration = ?", [name, nCalibration]) is not None
+	return stage, fingerprint, cached
+
+def replaceWeights(db, labNumber, weightType, nCalibration, runId, fingerprint=None):
+	# Every writer of weights calls this before writing a (weightType, nCalibration) combination for the lab: it deletes all of the combination's rows, whichever function wrote them (older versions of this code included, which kept every set), so there's never more than one weight per reviewer and item, and records run runId in the combination's stageCache entry. Only assignWeights passes a fingerprint; the others leave the entry out of date, so assignWeights doesn't take their rows for its own. Doesn't commit.
+	db.cursor.execute("DELETE FROM "+db.storageTable('weights')+" WHERE labNumber = ? AND weightType = ? AND nCalibration = ?",[labNumber,weightType,nCalibration])
+	db.recordStage('weights '+weightType+' '+str(nCalibration), labNumber, fingerprint, runId)
+
+def assignWeights(db,labNumber,f,nCalibration=3,term='F2014',skipUnchanged=True):
+	# f is a weight function, a WeightScheme or the name of a registered one, or a list of these, and nCalibration may be a list too. Every combination comes from a single scan of the lab's evaluations (its EvaluationCube for registered schemes, one query for any other weight function), and is written in one transaction.
+	# Combinations whose inputs (the lab's evaluations, expert evaluations, rubric and rating keys, and the weight function itself) haven't changed since they were last assigned are skipped, unless skipUnchanged is False; the ones that are recomputed replace all of their weights for the lab (see replaceWeights).
+	functions = f if isinstance(f, list) else [f]
+	nCalibrations = nCalibration if isinstance(nCalibration, list) else [nCalibration]
+	schemes = [getWeightScheme(g) for g in functions if getWeightScheme(g) is not None]
+	others = [g for g in functions if getWeightScheme(g) is None]
+
+	stages = {}
+	labFingerprint = db.getLabFingerprint(labNumber, weightInputTables)
+	for n in nCalibrations:
+		for name, identity in [(scheme.name, scheme.identity()) for scheme in schemes]+[(g.__name__, functionIdentity(g)) for g in others]:
+			stages[(name, n)] = weightStage(db, labNumber, labFingerprint, name, identity, n, skipUnchanged)
+			if stages[(name, n)][2]:
+				print('Weights '+name+' for nCalibration = '+str(n)+' are up to date for lab '+str(labNumber))
+	schemes = [scheme for scheme in schemes if not all(stages[(scheme.name, n)][2] for n in nCalibrations)]
+	others = [g for g in others if not all(stages[(g.__name__, n)][2] for n in nCalibrations)]
+	if schemes == [] and others == []:
+		return
+	scoresDict = db.getScoresDict(labNumber)
+	cube = loadEvaluationCube(db, labNumber) if schemes != [] else None
+	calibrationRows = getCalibrationRows(db, labNumber) if others != [] else []
+
+	runId = db.beginRun('assignWeights '+','.join([scheme.name for scheme in schemes]+[g.__name__ for g in others]), labNumber, term)
+	nRows = 0
+	for n in nCalibrations:
+		theseSchemes = [scheme for scheme in schemes if not stages[(scheme.name, n)][2]]
+		theseOthers = [g for g in others if not stages[(g.__name__, n)][2]]
+		for name in [scheme.name for scheme in theseSchemes]+[g.__name__ for g in theseOthers]:
+			stage, fingerprint, cached = stages[(name, n)]
+			replaceWeights(db, labNumber, name, n, runId, fingerprint)
+		if theseSchemes != []:
+			data, weights = computeWeights(cube, theseSchemes, scoresDict, n)
+			for scheme in theseSchemes:
+				nRows += db.insertRows('weights', weightsColumns, ([term, labNumber, n, wID, itemIndex, scheme.name, float(weight), runId]
+					for wID, wIDweights in zip(data.wIDs, weights[scheme.name]) for itemIndex, weight in zip(data.itemIndices, wIDweights)))
+		if theseOthers != []:
+			pairs = getExpertResponsePairs([entry[:5] for entry in calibrationRows if entry[5] in calibrationKinds[n]])
+			if len(pairs) == 0:
+				print('No calibration responses for nCalibration = '+str(n))
+				continue
+			for g in theseOthers:
+				nRows += db.insertRows('weights', weightsColumns, pairWeightRows(pairs, g(pairs, scoresDict), term, labNumber, n, g.__name__, runId))
+	db.endRun(runId, nRows)
+	db.conn.commit()
+
+calibrationLabelFilters = {
+	3: "NOT expertEvaluations.videoLabel LIKE 'Practice%'",
+	2: "NOT expertEvaluations.videoLabel LIKE 'Practice%' AND NOT expertEvaluations.videoLabel LIKE 'Hidden%'",
+	1: "expertEvaluations.videoLabel LIKE 'Hidden%'"
+	}
+
+def assignWeightsInSQL(db,labNumber,f,nCalibration=3,term='F2014'):
+	# assignWeights for curve schemes (anything else is a ValueError), with the weights worked out and written by SQLite itself so that no rows go through Python. Since SQLite adds up the credit before dividing by E, weights can differ from assignWeights' in the last bit.
+	functions = f if isinstance(f, list) else [f]
+	nCalibrations = nCalibration if isinstance(nCalibration, list) else [nCalibration]
+	schemes = []
+	for g in functions:
+		scheme = getWeightScheme(g)
+		if scheme is None:
+			raise ValueError(str(g)+' is not a registered weight scheme')
+		schemes.append(scheme)
+	credits = [scheme.sqlCredit('abs(weightKeyPairs.s - weightKeyPairs.x)') for scheme in schemes]
+
+	# The pairs carry the reviewers' integer keys, so the weights can go straight into weightsFact (see SWAPRdb.insertRows)
+	db.cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS weightKeyPairs
+		(wIDkey int, URL text, itemIndex int, s, x, counted int)''')
+	runId = db.beginRun('assignWeightsInSQL '+','.join([scheme.name for scheme in schemes]), labNumber, term)
+	nRows = 0
+	for n in nCalibrations:
+		db.cursor.execute("DELETE FROM weightKeyPairs")
+		db.cursor.execute('''INSERT INTO weightKeyPairs(wIDkey, URL, itemIndex, s, x, counted)
+			SELECT e.wIDkey, videoKeys.URL, e.itemIndex, e.rating, expertEvaluations.rating, 0
+			FROM studentEvaluationsFact e, videoKeys, expertEvaluations, rubrics 
+			WHERE 
+				videoKeys.URLkey = e.URLkey
+				AND e.itemIndex = expertEvaluations.itemIndex 
+				AND e.itemIndex = rubrics.itemIndex 
+				AND e.labNumber = ? 
+				AND rubrics.labNumber = e.labNumber 
+				AND expertEvaluations.labNumber = e.labNumber
+				AND rubrics.graded 
+				AND expertEvaluations.URL = videoKeys.URL 
+				AND '''+calibrationLabelFilters[n],[labNumber])
+		# As in the weight functions, only pairs with every item there, and a number for every expert rating, count
+		db.cursor.execute('''UPDATE weightKeyPairs SET counted = 1 WHERE (wIDkey, URL) IN
+			(SELECT wIDkey, URL FROM weightKeyPairs GROUP BY wIDkey, URL
+				HAVING count(*) = (SELECT count(DISTINCT itemIndex) FROM weightKeyPairs) AND total(typeof(x) IN ('integer', 'real')) = count(*))''')
+		for scheme, credit in zip(schemes, credits):
+			replaceWeights(db, labNumber, scheme.name, n, runId)
+			# Every reviewer with any calibration responses gets a weight for every item: the total credit over their counted pairs, divided by E, the number of calibration videos they rated
+			db.cursor.execute('''INSERT INTO weightsFact(term, labNumber, nCalibration, wIDkey, itemIndex, weightType, weight, runId)
+				SELECT ?, ?, ?, reviewers.wIDkey, items.itemIndex, ?, coalesce(credits.credit, 0.0)/reviewers.E, ?
+				FROM (SELECT wIDkey, count(DISTINCT URL) AS E FROM weightKeyPairs GROUP BY wIDkey) reviewers
+					CROSS JOIN (SELECT DISTINCT itemIndex FROM weightKeyPairs) items
+					LEFT JOIN (SELECT wIDkey, itemIndex, total('''+credit+''') AS credit FROM weightKeyPairs
+						WHERE counted AND typeof(s) IN ('integer', 'real')
+						GROUP BY wIDkey, itemIndex) credits
+					ON credits.wIDkey = reviewers.wIDkey AND credits.itemIndex = items.itemIndex
+				ORDER BY reviewers.wIDkey, items.itemIndex''',[term, labNumber, n, scheme.name, runId])
+			nRows += db.cursor.rowcount
+	db.cursor.execute("DELETE FROM weightKeyPairs")
+	db.endRun(runId, nRows)
 	db.conn.commit()
 
+def updateWeights(db,labNumber,f,nCalibration=3,term='F2014'):
+	# Bring the weights from registered schemes f (one, or a list) up to date, recomputing and replacing those of only the reviewers whose evaluations changed since the last updateWeights (see SWAPRdb.getChanges). The first time, or after the lab's expert evaluations or rubric change, that's everyone, and all of the combination's old weights are replaced, as in assignWeights (see replaceWeights). Either way, assignWeights recomputes the combination the next time it's called.
+	functions = f if isinstance(f, list) else [f]
+	nCalibrations = nCalibration if isinstance(nCalibration, list) else [nCalibration]
+	schemes = []
+	for g in functions:
+		scheme = getWeightScheme(g)
+		if scheme is None:
+			raise ValueError(str(g)+' is not a registered weight scheme')
+		schemes.append(scheme)
+	changes = {}
+	for n in nCalibrations:
+		for scheme in schemes:
+			changes[(scheme.name, n)] = db.getChanges('weights '+scheme.name+' '+str(n), labNumber)
+	if any(wIDs is None for wIDs, changeId in changes.values()):
+		cube = loadEvaluationCube(db, labNumber)
+	else:
+		changed = sorted(set(wID for wIDs, changeId in changes.values() for wID in wIDs))
+		if changed == []:
+			print('Weights for lab '+str(labNumber)+' are up to date')
+			return
+		cube = buildEvaluationCube(db, labNumber, wIDs=changed)
+	scoresDict = db.getScoresDict(labNumber)
+
+	runId = db.beginRun('updateWeights '+','.join([scheme.name for scheme in schemes]), labNumber, term)
+	nRows = 0
+	for n in nCalibrations:
+		data, weights = computeWeights(cube, schemes, scoresDict, n)
+		for scheme in schemes:
+			wIDs, changeId = changes[(scheme.name, n)]
+			if wIDs is None:
+				replaceWeights(db, labNumber, scheme.name, n, runId)
+			else:
+				for i in range(0, len(wIDs), 500):
+					chunk = wIDs[i:i+500]
+					db.cursor.execute("DELETE FROM weightsFact WHERE labNumber = ? AND weightType = ? AND nCalibration = ? AND wIDkey IN (SELECT wIDkey FROM studentKeys WHERE wID IN ("+','.join(['?']*len(chunk))+"))",[labNumber,scheme.name,n]+chunk)
+				db.recordStage('weights '+scheme.name+' '+str(n), labNumber, None, runId)
+			recompute = None if wIDs is None else set(wIDs)
+			nRows += db.insertRows('weights', weightsColumns, ([term, labNumber, n, wID, itemIndex, scheme.name, float(weight), runId]
+				for wID, wIDweights in zip(data.wIDs, weights[scheme.name]) if recompute is None or wID in recompute
+				for itemIndex, weight in zip(data.itemIndices, wIDweights)))
+			db.setWatermark('weights '+scheme.name+' '+str(n), labNumber, changeId)
+	db.endRun(runId, nRows)
+	db.conn.commit()
+	print('Recomputed the weights of '+str(len(cube.wIDs))+' reviewers for lab '+str(labNumber))
@@ -1,12 +1,12 @@
 from SWAPR3 import *
-import sqlite3 as lite
 import matplotlib.pyplot as plt
 import numpy as np
 from itertools import groupby
 
 # algsToGraph = algNamesStrings
-db = lite.connect('/Users/Scott/Research/SOUP 2017 SWAPR/SOUP2017.sqlite')
-cur = db.cursor()
+# Read-only connection, so this can run while an ingest or grading run is writing (once SWAPR3run.py has switched the database to WAL)
+db = SWAPRdb('/Users/Scott/Research/SOUP 2017 SWAPR/SOUP2017.sqlite', profile='report', readers=1)
+cur = db.reader().cursor()
 
 weightType = 'weightBIBI'
 algorithm = 'offMean_1'